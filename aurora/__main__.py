@@ -5,21 +5,26 @@ import asyncio
 
 import uvloop
 from sanic import Sanic
-from sanic_openapi import swagger_blueprint, openapi_blueprint
 from sanic_cors import CORS, cross_origin
 from signal import signal, SIGINT
 
-from aurora.configuration import Configuration
+from aurora.configuration import Configuration, get_config
 from aurora import protocols
+from aurora import lights
+from aurora import scenes
 from aurora.api import api
 from aurora import hardware
+from aurora import outputs
+from aurora import cluster
+from aurora import metrics
 
 app = Sanic(__name__)
 CORS(app, automatic_options=True)
-config: Configuration = Configuration()
+config: Configuration = get_config()
 setproctitle(config.core.process_name)
 fifo_task: asyncio.Task = None
 server_task: asyncio.Task = None
+compositor_task: asyncio.Task = None
 
 
 def main():
@@ -27,6 +32,7 @@ def main():
     app.blueprint(api)
 
     if config.core.openapi:
+        from sanic_openapi import swagger_blueprint, openapi_blueprint
         app.blueprint(openapi_blueprint)
         app.blueprint(swagger_blueprint)
         app.config.API_VERSION = config.core.version
@@ -43,7 +49,15 @@ def main():
     loop = asyncio.get_event_loop()
 
     server_task = asyncio.ensure_future(server)
-    fifo_task = loop.create_task(protocols.read_fifo())
+    # Followers show the leader's visualizer instead of reading audio
+    if config.cluster.role != 'follower':
+        fifo_task = loop.create_task(protocols.read_fifo())
+    compositor_task = loop.create_task(lights.compositor.run())
+    loop.create_task(metrics.probe_loop_lag())
+    loop.create_task(scenes.store.load())
+    cluster.start(loop)
+    if hardware.get_backend().refresh_interval > 0:
+        loop.create_task(outputs.keep_alive(hardware.get_backend()))
 
     signal(SIGINT, lambda s, f: loop.stop())
 
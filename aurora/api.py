@@ -1,20 +1,77 @@
+import asyncio
+import hashlib
 import json
-from typing import List
-from pyximport import pyximport
+import os
+import time
+from typing import List, Tuple
 from sanic import Blueprint
 from sanic import response
-from sanic.exceptions import NotFound
+from sanic.exceptions import InvalidUsage, NotFound
 from sanic.request import Request
-from sanic_openapi import doc
 
-from aurora import lights
-from aurora.configuration import Configuration
+from aurora import lights, metrics, scenes
+from aurora.configuration import Channel, Configuration, get_config
 from aurora.preset import Preset
 
-pyximport.install()
-
 api = Blueprint('aurora-lights', url_prefix='/api/v2')
-config: Configuration = Configuration()
+config: Configuration = get_config()
+
+# The documentation is only imported when it is served
+if config.core.openapi:
+    from sanic_openapi import doc
+    summary = doc.summary
+else:
+    def summary(text):
+        return lambda handler: handler
+
+# Makes ETags based on the preset revision unique across restarts
+boot_id: str = os.urandom(4).hex()
+# Longest a client may wait for the presets to change, in seconds
+max_wait: float = 60.0
+
+
+class CachedJson(object):
+    """A JSON response body that is encoded once per revision of its data."""
+
+    def __init__(self, name: str, encode):
+        self.name = name
+        self.encode = encode
+        self.revision = None
+        self.body: bytes = None
+        self.etag: str = None
+
+    def get(self, revision) -> Tuple[bytes, str]:
+        if self.body is None or revision != self.revision:
+            self.body = response.json_dumps(self.encode()).encode()
+            if revision is None:
+                digest = hashlib.sha1(self.body).hexdigest()[:16]
+                self.etag = '"{}-{}"'.format(self.name, digest)
+            else:
+                self.etag = '"{}-{}-{}"'.format(self.name, boot_id, revision)
+            self.revision = revision
+        return self.body, self.etag
+
+
+def matches_etag(request: Request, etag: str) -> bool:
+    header = request.headers.get('If-None-Match')
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags
+
+
+def cached_response(request: Request, cached: CachedJson, revision=None):
+    body, etag = cached.get(revision)
+    if matches_etag(request, etag):
+        return response.raw(b'', status=304, headers={'ETag': etag})
+    return response.raw(body, content_type='application/json', headers={'ETag': etag})
+
+
+# The configuration is only read at startup, so its responses never change
+# while the server runs and are tagged with a digest of their content.
+channels_json = CachedJson('channels', lambda: config.hardware.channels)
+devices_json = CachedJson('devices', lambda: config.hardware.devices)
+presets_json = CachedJson('presets', lambda: [preset.as_dict() for preset in lights.presets])
 
 
 # --------------------------------------------------------------- #
@@ -22,7 +79,7 @@ config: Configuration = Configuration()
 # --------------------------------------------------------------- #
 
 @api.get('/')
-@doc.summary('Gets version information for api consumers')
+@summary('Gets version information for api consumers')
 async def get_info(request: Request):
     return response.json({
         "name": config.core.serverName,
@@ -36,9 +93,9 @@ async def get_info(request: Request):
 # --------------------------------------------------------------- #
 
 @api.get('/channels')
-@doc.summary('Gets a list of channels on the physical device.')
+@summary('Gets a list of channels on the physical device.')
 async def get_channels(request: Request):
-    return response.json(config.hardware.channels)
+    return cached_response(request, channels_json)
 
 
 # --------------------------------------------------------------- #
@@ -46,9 +103,19 @@ async def get_channels(request: Request):
 # --------------------------------------------------------------- #
 
 @api.get('/devices')
-@doc.summary('Gets a list of devices registered with the server.')
-async def get_channels(request: Request):
-    return response.json(config.hardware.devices)
+@summary('Gets a list of devices registered with the server.')
+async def get_devices(request: Request):
+    return cached_response(request, devices_json)
+
+
+@api.patch('/devices/<device>')
+@summary('Changes the levels of a device, updating the running preset in place when possible.')
+async def patch_device(request: Request, device):
+    if device not in lights.device_channels:
+        raise NotFound('No device exists with the given name.')
+    levels, duration = parse_patch(request, lights.device_channels[device])
+    psets = await lights.retarget_device(device, levels, duration)
+    return response.json({'status': 200, 'message': 'Ok.', 'presets': [p.as_dict() for p in psets]})
 
 
 # --------------------------------------------------------------- #
@@ -56,17 +123,22 @@ async def get_channels(request: Request):
 # --------------------------------------------------------------- #
 
 @api.get('/presets')
-@doc.summary('Gets a list of presets that are currently displaying.')
+@summary('Gets a list of presets that are currently displaying. '
+         'With ?wait=<seconds> and If-None-Match the request is held until the presets change.')
 async def get_presets(request: Request):
-    psets = []
-    for preset in lights.presets:
-        psets.append(preset.as_dict())
-    return response.json(psets)
+    _, etag = presets_json.get(lights.presets.revision)
+    if 'wait' in request.args and matches_etag(request, etag):
+        try:
+            timeout = min(max(float(request.args.get('wait')), 0.0), max_wait)
+        except ValueError:
+            raise InvalidUsage('wait must be a number of seconds.')
+        await lights.presets.wait(lights.presets.revision, timeout)
+    return cached_response(request, presets_json, lights.presets.revision)
 
 
 @api.post('/presets')
-@doc.summary('Creates a new preset with the given specifications. '
-             'Any existing presets with conflicting channels are removed.')
+@summary('Creates a new preset with the given specifications. '
+         'Any existing presets with conflicting channels are removed.')
 async def post_presets(request: Request):
     body = json.loads(request.body)
     new_presets: List[Preset] = []
@@ -79,14 +151,13 @@ async def post_presets(request: Request):
 
     await lights.put_presets(new_presets)
 
-    psets = []
-    for preset in lights.presets:
-        psets.append(preset.as_dict())
-    return response.json({'status': 201, 'message': 'Created.', 'presets': psets}, status=201)
+    psets, _ = presets_json.get(lights.presets.revision)
+    body = b'{"status":201,"message":"Created.","presets":' + psets + b'}'
+    return response.raw(body, status=201, content_type='application/json')
 
 
 @api.delete('/presets')
-@doc.summary('Stops all presets executing on the server.')
+@summary('Stops all presets executing on the server.')
 async def delete_presets(request: Request):
     await lights.clear_presets()
     return response.json({'status': 200, 'message': 'Ok.'})
@@ -97,22 +168,222 @@ async def delete_presets(request: Request):
 # --------------------------------------------------------------- #
 
 @api.get('/presets/<preset_id:int>')
-@doc.summary('Gets a the value of a preset with a specific ID')
+@summary('Gets a the value of a preset with a specific ID')
 async def get(request: Request, preset_id):
-    for preset in lights.presets:
-        if preset.id == int(preset_id):
-            return response.json(preset.as_dict())
-    raise NotFound('No preset exists with the given id.')
+    preset = lights.presets.get(int(preset_id))
+    if preset is None:
+        raise NotFound('No preset exists with the given id.')
+    return response.json(preset.as_dict())
+
+
+@api.patch('/presets/<preset_id:int>')
+@summary('Changes the levels of a running levels or fade preset without restarting it. '
+         'The preset then holds the levels given in its levels field, a fade stops cycling.')
+async def patch(request: Request, preset_id):
+    preset = lights.presets.get(int(preset_id))
+    if preset is None:
+        raise NotFound('No preset exists with the given id.')
+    levels, duration = parse_patch(request, preset.channels)
+    lights.retarget_preset(preset, levels, duration)
+    return response.json(preset.as_dict())
 
 
 @api.delete('/presets/<preset_id:int>')
-@doc.summary('Removes a preset with a specific ID')
+@summary('Removes a preset with a specific ID')
 async def delete(request: Request, preset_id):
-    for preset in lights.presets:
-        if preset.id == int(preset_id):
-            await lights.remove_presets_by_id([preset_id])
-            return response.json({'status': 200, 'message': 'Deleted.'})
-    raise NotFound('No preset exists with the given id.')
+    if int(preset_id) not in lights.presets:
+        raise NotFound('No preset exists with the given id.')
+    await lights.remove_presets_by_id([int(preset_id)])
+    return response.json({'status': 200, 'message': 'Deleted.'})
+
+
+def parse_patch(request: Request, channels: List[Channel]):
+    """Reads the levels and the optional duration of a PATCH body, e.g.
+    {"levels": {"red": 100}, "duration": 0.1}. Every label must belong to
+    one of the given channels.
+    """
+    try:
+        body = json.loads(request.body)
+        levels = body['levels']
+        duration = body.get('duration')
+        if not isinstance(levels, dict) or \
+                not all(isinstance(v, (int, float)) for v in levels.values()) or \
+                not (duration is None or isinstance(duration, (int, float))):
+            raise InvalidUsage('Invalid patch syntax.')
+    except (KeyError, TypeError, AttributeError, ValueError):
+        raise InvalidUsage('Invalid patch syntax.')
+
+    labels = {channel.label for channel in channels}
+    for label in levels:
+        if label not in labels:
+            raise InvalidUsage('No channel with the label ' + label + '.')
+    return levels, duration
+
+
+# --------------------------------------------------------------- #
+# API Route: /scenes
+# --------------------------------------------------------------- #
+
+@api.get('/scenes')
+@summary('Gets a list of saved scenes.')
+async def get_scenes(request: Request):
+    return response.json([scene.as_dict() for scene in scenes.store])
+
+
+@api.post('/scenes')
+@summary('Saves a scene, e.g. {"name": "evening", "presets": [...]}. '
+         'A scene with the same name is replaced.')
+async def post_scenes(request: Request):
+    body = json.loads(request.body)
+    if not isinstance(body, dict) or not isinstance(body.get('name'), str):
+        raise InvalidUsage('A scene needs a name.')
+    scene = await scenes.store.save(body['name'], body.get('presets'))
+    return response.json({'status': 201, 'message': 'Created.', 'scene': scene.as_dict()}, status=201)
+
+
+# --------------------------------------------------------------- #
+# API Route: /scenes/<name>
+# --------------------------------------------------------------- #
+
+@api.get('/scenes/<name>')
+@summary('Gets a saved scene by name.')
+async def get_scene(request: Request, name):
+    scene = scenes.store.get(name)
+    if scene is None:
+        raise NotFound('No scene exists with the given name.')
+    return response.json(scene.as_dict())
+
+
+@api.put('/scenes/<name>')
+@summary('Saves a scene under the given name. The body is the list of presets in the scene.')
+async def put_scene(request: Request, name):
+    scene = await scenes.store.save(name, json.loads(request.body))
+    return response.json({'status': 200, 'message': 'Ok.', 'scene': scene.as_dict()})
+
+
+@api.delete('/scenes/<name>')
+@summary('Deletes a saved scene.')
+async def delete_scene(request: Request, name):
+    if scenes.store.get(name) is None:
+        raise NotFound('No scene exists with the given name.')
+    await scenes.store.delete(name)
+    return response.json({'status': 200, 'message': 'Deleted.'})
+
+
+@api.post('/scenes/<name>/activate')
+@summary('Shows the presets of a saved scene, replacing conflicting presets.')
+async def activate_scene(request: Request, name):
+    if scenes.store.get(name) is None:
+        raise NotFound('No scene exists with the given name.')
+    psets = await scenes.store.activate(name)
+    return response.json({'status': 200, 'message': 'Ok.', 'presets': [p.as_dict() for p in psets]})
+
+
+# --------------------------------------------------------------- #
+# API Route: /metrics
+# --------------------------------------------------------------- #
+
+@api.get('/metrics')
+@summary('Gets the metrics of the server in the Prometheus text format.')
+async def get_metrics(request: Request):
+    return response.text(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api.middleware('request')
+async def start_request_timer(request: Request):
+    request.ctx.started_at = time.perf_counter()
+
+
+@api.middleware('response')
+async def record_request_time(request: Request, resp):
+    # Requests held until the presets change would only measure the wait
+    started_at = getattr(request.ctx, 'started_at', None)
+    if started_at is not None and 'wait' not in request.args:
+        metrics.http_request_seconds.observe(time.perf_counter() - started_at)
+
+
+# --------------------------------------------------------------- #
+# API Route: /live
+# --------------------------------------------------------------- #
+
+@api.websocket('/live')
+async def live(request: Request, ws):
+    """Sets levels directly from a stream of messages. Each message is
+    either JSON, e.g. {"device": "main", "levels": {"red": 100}} or
+    {"pins": [0, 2], "levels": [100, 50]} or a list of those, or binary
+    pairs of unsigned bytes (pin, level). Only the latest level of each
+    channel is shown when messages arrive faster than the frame rate.
+    """
+    while True:
+        message = await ws.recv()
+        if message is None:
+            return
+        try:
+            channels, levels = parse_live(message)
+        except InvalidUsage as e:
+            await ws.send(json.dumps({'status': 400, 'message': str(e)}))
+            continue
+        await lights.put_live_levels(channels, levels)
+
+
+@api.websocket('/levels')
+async def stream_levels(request: Request, ws):
+    """Sends the level of every pin whenever it changes, at most `rate`
+    times per second. The first message lists the pins, e.g. {"pins": [3, 2, 0]}.
+    With format=binary every update is one byte per pin in that order,
+    otherwise it is JSON, e.g. {"revision": 12, "levels": [100, 0, 50]}.
+    """
+    try:
+        rate = min(max(float(request.args.get('rate', 10)), 0.1), config.core.frame_rate)
+    except ValueError:
+        # The connection is upgraded already, a 400 can't be sent anymore
+        await ws.close(code=1008, reason='rate must be a number.')
+        return
+    binary = request.args.get('format') == 'binary'
+
+    await ws.send(json.dumps({'pins': lights.feed.pins}))
+    queue = lights.feed.subscribe()
+    try:
+        deadline = time.monotonic()
+        while True:
+            _, levels, text = await queue.get()
+            await ws.send(levels if binary else text)
+            deadline = max(deadline + 1.0 / rate, time.monotonic())
+            await asyncio.sleep(deadline - time.monotonic())
+    finally:
+        lights.feed.unsubscribe(queue)
+
+
+def parse_live(message) -> Tuple[List[Channel], List[int]]:
+    channels: List[Channel] = []
+    levels: List[int] = []
+
+    try:
+        if isinstance(message, (bytes, bytearray)):
+            if len(message) % 2 != 0:
+                raise InvalidUsage('Binary messages must be pairs of pin and level.')
+            pairs = list(message)
+            channels = [config.hardware.channels_dict[pin] for pin in pairs[0::2]]
+            levels = pairs[1::2]
+        else:
+            body = json.loads(message)
+            for item in body if isinstance(body, list) else [body]:
+                if 'pins' in item:
+                    channels += [config.hardware.channels_dict[pin] for pin in item['pins']]
+                    levels += item['levels']
+                else:
+                    device_levels = item['levels']
+                    for channel in lights.device_channels[item['device']]:
+                        if channel.label in device_levels:
+                            channels.append(channel)
+                            levels.append(device_levels[channel.label])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidUsage('Invalid live message.')
+
+    if len(channels) != len(levels) or \
+            not all(isinstance(v, int) and 0 <= v <= 100 for v in levels):
+        raise InvalidUsage('Invalid live message.')
+    return channels, levels
 
 
 # --------------------------------------------------------------- #
@@ -121,6 +392,10 @@ async def delete(request: Request, preset_id):
 
 @api.options('/presets/<preset_id:int>')
 @api.options('/presets')
+@api.options('/devices/<device>')
+@api.options('/scenes')
+@api.options('/scenes/<name>')
+@api.options('/scenes/<name>/activate')
 async def empty_response(*args, **kwargs):
     return response.text('', status=204)
 
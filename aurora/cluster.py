@@ -0,0 +1,404 @@
+import asyncio
+import bisect
+import json
+import os
+import socket
+import struct
+import time
+import zlib
+from collections import deque
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from aurora import hardware
+from aurora.configuration import Channel, Configuration, get_config
+from aurora.outputs import OutputBackend
+
+config = get_config()
+
+# Every datagram starts with the magic, the kind of datagram, the session of
+# the leader, the id of its channel map, the sequence number of the last
+# frame and the time on the leader's clock. A frame carries one level per
+# channel of the map as a 16 bit integer, 65535 being level 100. A map
+# carries the JSON list of the [device, label] of each channel.
+header = struct.Struct('!4sBIHId')
+frame_type = np.dtype('>u2')
+frame_scale = 65535 / 100
+MAGIC = b'AURC'
+KIND_FRAME = 1
+KIND_MAP = 2
+
+# Seconds between repeats of the map and of the last frame when nothing changes
+map_interval = 1.0
+keepalive_interval = 0.5
+
+# Number of recent frames whose delay is used to estimate the clock offset
+offset_window = 256
+
+# Seconds without frames after which the leader is considered gone
+leader_timeout = 3.0
+
+
+def open_socket(cluster: 'Configuration.Cluster', receive: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        # Lets several followers on one host share the port
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    multicast = socket.inet_aton(cluster.group)[0] & 0xf0 == 0xe0
+    interface = socket.inet_aton(cluster.interface)
+
+    if receive:
+        sock.bind(('', cluster.port))
+        if multicast:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(cluster.group) + interface)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if multicast:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if cluster.interface != '0.0.0.0':
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, interface)
+    sock.setblocking(False)
+    return sock
+
+
+class LeaderBackend(OutputBackend):
+    """Shows the levels on the leader's own lights through another backend
+    and multicasts every frame to the followers.
+
+    The frame holds the level of every configured channel before it was
+    corrected for the leader's devices, so each follower applies its own
+    correction. It is sent whenever a flush wrote something and repeated
+    while nothing changes, so followers can keep their clocks in step. The
+    channel map is sent every map_interval.
+
+    Followers show a frame `delay` seconds after it was sent. The writes of
+    each flush are held just as long before they reach the inner backend,
+    so the leader's lights change at the same moment as everyone else's.
+    """
+
+    def __init__(self, inner: OutputBackend, channels: List[Channel], delay: float,
+                 loop: asyncio.AbstractEventLoop):
+        self.inner = inner
+        self.delay = delay
+        self.loop = loop
+        # Writes since the last flush, and the flushes waiting to be shown
+        self.pending_pins: List[int] = []
+        self.pending_levels: List[int] = []
+        self.held: deque = deque()
+        self.refresh_interval = keepalive_interval
+        self.max_level = inner.max_level
+        self.session = int.from_bytes(os.urandom(4), 'big')
+        self.pins: List[int] = [c.pin for c in channels]
+        self.indices: Dict[int, int] = {c.pin: i for i, c in enumerate(channels)}
+
+        self.map_payload = json.dumps([[c.device, c.label] for c in channels]).encode()
+        self.map_id = zlib.crc32(self.map_payload) & 0xffff
+        self.map_packet = bytearray(header.size) + self.map_payload
+        self.packet = bytearray(header.size + len(channels) * frame_type.itemsize)
+        self.frame = np.frombuffer(self.packet, dtype=frame_type, offset=header.size)
+        self.sequence = 0
+        self.dirty = False
+        self.frame_sent_at = 0.0
+        self.map_sent_at = 0.0
+
+        self.sock = open_socket(config.cluster, receive=False)
+        self.address = (config.cluster.group, config.cluster.port)
+        self.frames_sent = 0
+        self.send_errors = 0
+
+    def enable(self, pins: List[int]):
+        self.inner.enable(pins)
+
+    def disable(self, pins: List[int]):
+        self.hold(self.inner.disable, list(pins))
+        for pin in pins:
+            index = self.indices.get(pin)
+            if index is not None:
+                self.frame[index] = 0
+        self.send_frame(time.monotonic())
+
+    def write(self, pin: int, level: int):
+        self.pending_pins.append(pin)
+        self.pending_levels.append(level)
+        if pin in self.indices:
+            self.dirty = True
+
+    def flush(self):
+        if len(self.pending_pins) > 0:
+            self.hold(self.show, (tuple(self.pending_pins), tuple(self.pending_levels)))
+            self.pending_pins.clear()
+            self.pending_levels.clear()
+        if self.dirty:
+            self.update_frame()
+            self.send_frame(time.monotonic())
+
+    def hold(self, function, argument):
+        """Calls function(argument) once the followers show what is sent now."""
+        if self.delay <= 0:
+            function(argument)
+            return
+        # Every call is held equally long, so they are released in order,
+        # one per timer
+        self.held.append((function, argument))
+        self.loop.call_later(self.delay, self.release)
+
+    def release(self):
+        function, argument = self.held.popleft()
+        function(argument)
+
+    def show(self, writes: Tuple[Tuple[int, ...], Tuple[int, ...]]):
+        for pin, level in zip(*writes):
+            self.inner.write(pin, level)
+        self.inner.flush()
+
+    def update_frame(self):
+        levels = np.array(hardware.get_levels(self.pins))
+        self.frame[:] = np.rint(np.clip(levels, 0, 100) * frame_scale)
+
+    def refresh(self):
+        self.inner.refresh()
+        now = time.monotonic()
+        if now - self.map_sent_at >= map_interval:
+            self.send(self.map_packet, KIND_MAP, now)
+            self.map_sent_at = now
+        if self.dirty:
+            self.update_frame()
+        if self.dirty or now - self.frame_sent_at >= keepalive_interval:
+            self.send_frame(now)
+
+    def send_frame(self, now: float):
+        self.dirty = False
+        self.frame_sent_at = now
+        self.sequence += 1
+        self.send(self.packet, KIND_FRAME, now)
+
+    def send(self, packet: bytearray, kind: int, now: float):
+        header.pack_into(packet, 0, MAGIC, kind, self.session, self.map_id, self.sequence, now)
+        try:
+            self.sock.sendto(packet, self.address)
+            self.frames_sent += 1
+        except OSError as e:
+            self.send_errors += 1
+            if config.core.debug:
+                print('Cluster: Frame not sent: ' + str(e))
+
+    def get_counters(self) -> Dict[str, int]:
+        counters = dict(self.inner.get_counters())
+        counters['cluster_frames_sent'] = self.frames_sent
+        counters['cluster_send_errors'] = self.send_errors
+        return counters
+
+
+class JitterBuffer(object):
+    """Frames waiting to be shown, ordered by sequence number.
+
+    The leader's clock is mapped onto the local one with the smallest
+    difference between the two seen over the last offset_window frames,
+    i.e. the frame that had the shortest trip. Each frame is shown `delay`
+    seconds after the leader sent it by that estimate.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.frames: List[Tuple[int, float, bytes]] = []
+        self.offsets: deque = deque(maxlen=offset_window)
+        self.offset = 0.0
+        self.last_sequence = 0
+        self.highest_sequence = 0
+
+        self.frames_received = 0
+        self.frames_late = 0
+        self.frames_lost = 0
+        self.frames_skipped = 0
+
+    def reset(self):
+        self.frames.clear()
+        self.offsets.clear()
+        self.last_sequence = 0
+        self.highest_sequence = 0
+
+    def observe(self, sent_at: float, received_at: float):
+        """Updates the clock offset with a datagram sent at `sent_at` on the
+        leader's clock.
+        """
+        self.offsets.append(received_at - sent_at)
+        self.offset = min(self.offsets)
+
+    def push(self, sequence: int, sent_at: float, levels: bytes):
+        self.frames_received += 1
+        if sequence <= self.last_sequence:
+            # Arrived after a newer frame was shown
+            self.frames_late += 1
+            return
+
+        if sequence > self.highest_sequence:
+            if self.highest_sequence > 0:
+                self.frames_lost += sequence - self.highest_sequence - 1
+            self.highest_sequence = sequence
+        else:
+            # Reordered, it was counted as lost when the gap was seen
+            self.frames_lost -= 1
+
+        bisect.insort(self.frames, (sequence, sent_at, levels))
+
+    def next_due(self) -> float:
+        """Returns the local time the oldest waiting frame is due, or None."""
+        if len(self.frames) == 0:
+            return None
+        return self.frames[0][1] + self.offset + self.delay
+
+    def pop_due(self, now: float) -> bytes:
+        """Returns the newest frame that is due, or None. Older frames that
+        are due as well are dropped.
+        """
+        due = None
+        while len(self.frames) > 0 and self.frames[0][1] + self.offset + self.delay <= now:
+            if due is not None:
+                self.frames_skipped += 1
+            sequence, _, due = self.frames.pop(0)
+            self.last_sequence = sequence
+        return due
+
+
+class Follower(asyncio.DatagramProtocol):
+    """Shows the frames multicast by the leader on the local lights.
+
+    Each local channel takes the level of the leader's channel with the same
+    device and label. Local channels the leader doesn't have are left alone.
+    Lost frames are concealed by holding the last levels until the next frame
+    arrives.
+    """
+
+    def __init__(self, channels: List[Channel], delay: float):
+        super().__init__()
+        self.channels = channels
+        self.buffer = JitterBuffer(delay)
+        self.wakeup = asyncio.Event()
+        self.session = None
+        self.map_id = None
+        self.pins = np.zeros(0, dtype=np.intc)
+        self.indices = np.zeros(0, dtype=np.intp)
+        self.levels = np.zeros(0, dtype=np.float64)
+        self.received_at = 0.0
+        self.leader_present = False
+
+        self.invalid_datagrams = 0
+        self.frames_shown = 0
+        self.unmapped_frames = 0
+
+    def datagram_received(self, data: bytes, address):
+        now = time.monotonic()
+        if len(data) < header.size or data[:4] != MAGIC:
+            self.invalid_datagrams += 1
+            return
+        _, kind, session, map_id, sequence, sent_at = header.unpack_from(data)
+
+        if session != self.session:
+            # The leader has restarted, its clock and sequence start over
+            if config.core.debug:
+                print('Cluster: Following leader ' + '{:08x}'.format(session) + ' at ' + str(address[0]))
+            self.session = session
+            self.map_id = None
+            self.buffer.reset()
+
+        self.received_at = now
+        self.leader_present = True
+        self.buffer.observe(sent_at, now)
+
+        if kind == KIND_MAP:
+            if map_id != self.map_id:
+                try:
+                    leader_channels = json.loads(data[header.size:].decode())
+                    self.set_map(map_id, leader_channels)
+                except (ValueError, TypeError):
+                    self.invalid_datagrams += 1
+        elif kind == KIND_FRAME:
+            if map_id != self.map_id:
+                self.unmapped_frames += 1
+                return
+            self.buffer.push(sequence, sent_at, data[header.size:])
+            self.wakeup.set()
+
+    def set_map(self, map_id: int, leader_channels: List[List[str]]):
+        positions = {(device, label): i for i, (device, label) in enumerate(leader_channels)}
+        pins = []
+        indices = []
+        for channel in self.channels:
+            index = positions.get((channel.device, channel.label))
+            if index is not None:
+                pins.append(channel.pin)
+                indices.append(index)
+
+        self.pins = np.array(pins, dtype=np.intc)
+        self.indices = np.array(indices, dtype=np.intp)
+        self.levels = np.zeros(len(pins), dtype=np.float64)
+        self.map_id = map_id
+        if config.core.debug:
+            print('Cluster: Showing ' + str(len(pins)) + ' of ' + str(len(leader_channels)) + ' leader channels')
+
+    def show(self, frame: bytes):
+        if len(frame) // frame_type.itemsize <= self.indices.max(initial=-1):
+            self.invalid_datagrams += 1
+            return
+        levels = np.frombuffer(frame, dtype=frame_type, count=len(frame) // frame_type.itemsize)
+        np.divide(levels[self.indices], frame_scale, out=self.levels)
+        hardware.set_levels(self.pins, self.levels)
+        self.frames_shown += 1
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        await loop.create_datagram_endpoint(lambda: self,
+                                            sock=open_socket(config.cluster, receive=True))
+
+        while True:
+            due = self.buffer.next_due()
+            if due is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), leader_timeout)
+                except asyncio.TimeoutError:
+                    if self.leader_present and time.monotonic() - self.received_at >= leader_timeout:
+                        self.leader_present = False
+                        if config.core.debug:
+                            print('Cluster: No frames from the leader, holding the last levels')
+                continue
+
+            now = time.monotonic()
+            if due > now:
+                # A frame that arrives meanwhile can't be due any sooner,
+                # frames are sent in order
+                await asyncio.sleep(due - now)
+
+            frame = self.buffer.pop_due(time.monotonic())
+            if frame is not None:
+                self.show(frame)
+
+    def get_counters(self) -> Dict[str, int]:
+        return {
+            'frames_received': self.buffer.frames_received,
+            'frames_shown': self.frames_shown,
+            'frames_late': self.buffer.frames_late,
+            'frames_lost': self.buffer.frames_lost,
+            'frames_skipped': self.buffer.frames_skipped,
+            'unmapped_frames': self.unmapped_frames,
+            'invalid_datagrams': self.invalid_datagrams,
+        }
+
+
+follower: Follower = None
+
+
+def start(loop: asyncio.AbstractEventLoop):
+    """Starts the role set in the cluster section of the config file."""
+    global follower
+    if config.cluster.role == 'leader':
+        hardware.set_backend(LeaderBackend(hardware.get_backend(), config.hardware.channels,
+                                           config.cluster.buffer_delay, loop))
+    elif config.cluster.role == 'follower':
+        follower = Follower(config.hardware.channels, config.cluster.buffer_delay)
+        loop.create_task(follower.run())
+    elif config.cluster.role != 'standalone':
+        raise ValueError('Unknown cluster role: ' + str(config.cluster.role))
@@ -21,6 +21,8 @@ class Configuration(object):
             self.process_name = "aurora-server"
             self.enable_transitions: bool = config.getboolean(section, 'enableTransitions')
             self.transition_duration: float = config.getfloat(section, 'transitionDuration')
+            self.frame_rate: float = config.getfloat(section, 'frameRate', fallback=60.0)
+            self.scene_path: str = config.get(section, 'sceneDatabase', fallback='/var/lib/aurora/scenes.db')
             self.serverName: str = config.get(section, 'serverName')
             self.description: str = config.get(section, 'description')
             self.version = "2.3.0"
@@ -46,6 +48,33 @@ class Configuration(object):
                     self.devices.append(json_pin['device'])
                 self.channels.append(Channel(json_pin))
                 self.channels_dict[int(json_pin['pin'])] = Channel(json_pin)
+            self.output: str = config.get(section, 'output', fallback='wiringpi')
+            self.output_host: str = config.get(section, 'outputHost', fallback='')
+            self.output_port: int = config.getint(section, 'outputPort', fallback=0)
+            self.universe: int = config.getint(section, 'universe', fallback=-1)
+            self.pwm_range: int = config.getint(section, 'pwmRange', fallback=100)
+            self.dithering: bool = config.getboolean(section, 'dithering', fallback=False)
+            self.corrections: List[Configuration.Correction] = []
+            for c_dict in json.loads(config.get(section, 'corrections', fallback='[]')):
+                self.corrections.append(Configuration.Correction(c_dict))
+
+        def get_correction(self, device: str) -> 'Configuration.Correction':
+            """Returns the correction of the given device, or one that leaves
+            its levels unchanged.
+            """
+            for c in self.corrections:
+                if c.device == device:
+                    return c
+            return Configuration.Correction(None)
+
+    class Correction(object):
+        def __init__(self, d):
+            self.device = None
+            self.gamma = 1.0
+            self.limit = 100
+            self.balance = {}
+            if d is not None:
+                self.__dict__.update(d)
 
     class Audio(object):
         def __init__(self, config: RawConfigParser):
@@ -55,6 +84,19 @@ class Configuration(object):
             self.sample_rate = config.getint(section, 'sampleRate')
             self.chunk_size = config.getint(section, 'chunkSize')
             self.audio_channels = config.getint(section, 'audioChannels')
+            self.sample_format = config.get(section, 'sampleFormat', fallback='S16_LE')
+            self.backlog_chunks = config.getint(section, 'backlogChunks', fallback=4)
+            self.visualizer_process = config.getboolean(section, 'visualizerProcess', fallback=False)
+            self.visualizer_cpu = config.getint(section, 'visualizerCpu', fallback=-1)
+
+    class Cluster(object):
+        def __init__(self, config: RawConfigParser):
+            section = 'cluster'
+            self.role: str = config.get(section, 'role', fallback='standalone')
+            self.group: str = config.get(section, 'group', fallback='239.255.77.77')
+            self.port: int = config.getint(section, 'port', fallback=5577)
+            self.interface: str = config.get(section, 'interface', fallback='0.0.0.0')
+            self.buffer_delay: float = config.getfloat(section, 'bufferDelay', fallback=0.1)
 
     class Filter(object):
         def __init__(self, d):
@@ -71,6 +113,9 @@ class Configuration(object):
             self.custom_channel_mapping = 0
             self.custom_channel_frequencies = 0
             self.input_channels = 2
+            self.audio_channel = 'mix'
+            self.fft_backend = 'auto'
+            self.stats_window = 0
             if d is not None:
                 self.__dict__.update(d)
 
@@ -81,7 +126,28 @@ class Configuration(object):
         self.core = Configuration.Core(config)
         self.hardware = Configuration.Hardware(config)
         self.audio = Configuration.Audio(config)
+        self.cluster = Configuration.Cluster(config)
 
         self.filters = []
         for v_dict in json.loads(config.get('visualizer', 'filters')):
             self.filters.append(Configuration.Filter(v_dict))
+
+    def get_filter(self, name: str) -> 'Configuration.Filter':
+        """Returns the filter with the given name, or the default filter."""
+        for f in self.filters:
+            if f.name == name:
+                return f
+        return Configuration.Filter(None)
+
+
+shared_config: Configuration = None
+
+
+def get_config() -> Configuration:
+    """Returns the configuration shared by every module. The config file is
+    only read the first time this is called.
+    """
+    global shared_config
+    if shared_config is None:
+        shared_config = Configuration()
+    return shared_config
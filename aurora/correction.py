@@ -0,0 +1,41 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from aurora.configuration import Channel, Configuration
+
+# Entries of a lookup table per level, so every whole level has an entry
+# of its own. A table has STEPS_PER_LEVEL * 100 + 1 entries.
+STEPS_PER_LEVEL = 40
+TABLE_SIZE = STEPS_PER_LEVEL * 100 + 1
+
+
+def build_table(correction: Configuration.Correction, label: str, max_level: int) -> np.ndarray:
+    """Returns the lookup table of a channel with the given label.
+
+    Entry i holds the output value, from 0 to `max_level`, of the level
+    i / STEPS_PER_LEVEL. The level is scaled by the brightness limit of the
+    device and the balance of the channel, both in percent, and raised to
+    the gamma of the device. Values are not rounded so that they can be
+    dithered.
+    """
+    levels = np.linspace(0.0, 1.0, TABLE_SIZE)
+    scale = correction.limit / 100 * correction.balance.get(label, 100) / 100
+    return np.clip(max_level * scale * levels ** correction.gamma, 0, max_level)
+
+
+def build_tables(channels: List[Channel], hardware: Configuration.Hardware,
+                 max_level: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the row of the lookup table of every pin up to the highest
+    configured one, and the lookup tables, one row per channel.
+
+    Row 0 leaves levels uncorrected and is used by pins that are not
+    configured.
+    """
+    rows = np.zeros(max([c.pin for c in channels], default=0) + 1, dtype=np.intc)
+    tables = np.empty((len(channels) + 1, TABLE_SIZE), dtype=np.float64)
+    tables[0] = build_table(Configuration.Correction(None), None, max_level)
+    for i, channel in enumerate(channels):
+        tables[i + 1] = build_table(hardware.get_correction(channel.device), channel.label, max_level)
+        rows[channel.pin] = i + 1
+    return rows, tables
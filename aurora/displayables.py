@@ -1,136 +1,247 @@
 import math
-from abc import abstractmethod
-from asyncio import CancelledError
-from copy import deepcopy
-from typing import Dict, List
-import asyncio
+import time
+import copy
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import numpy as np
 from sanic.exceptions import InvalidUsage
-from aurora.configuration import Channel, Configuration
+from aurora.configuration import Channel, get_config
+from aurora import protocols
 from aurora.protocols import AudioFifoProtocol
-
-import pyximport
-pyximport.install()
-from aurora.visualizer.visualizer import Visualizer
+from aurora.visualizer.decode import MIX
 from aurora import hardware
 
-config = Configuration()
+config = get_config()
 pins: List[int] = []
 for channel in config.hardware.channels:
     pins.append(channel.pin)
 hardware.enable(pins)
 
+# Compiled displayables by payload hash, least recently used first
+templates: 'OrderedDict[bytes, Displayable]' = OrderedDict()
+template_cache_size = 128
+cache_hits = 0
+cache_misses = 0
+
+
+class Timeline(object):
+    """Keyframes of a displayable compiled into NumPy arrays.
+
+    Row i of `values` holds the level of every key at `times[i]`. Levels
+    between two keyframes are interpolated linearly and two keyframes with
+    the same time form a step. NaN means the key is not set yet. When
+    `loop_start` is set the timeline never ends; after the last keyframe it
+    loops back to that time.
+    """
+
+    def __init__(self, keys: List, times, values, loop_start: float = None):
+        self.keys: List = keys
+        self.columns: Dict = {key: i for i, key in enumerate(keys)}
+        self.times = np.asarray(times, dtype=np.float64)
+        self.values = np.asarray(values, dtype=np.float64).reshape(len(self.times), len(keys))
+        self.end: float = float(self.times[-1])
+        self.loop_start: float = loop_start
+        self.out = np.empty(len(keys), dtype=np.float64)
+
+    @classmethod
+    def from_keyframes(cls, keyframes: List[Tuple[float, Dict]], loop_start: float = None):
+        """Compiles a list of (time, levels) pairs. Keys missing from a
+        keyframe keep their value from the previous keyframe.
+        """
+        columns: Dict = {}
+        for _, levels in keyframes:
+            for key in levels:
+                columns.setdefault(key, len(columns))
+
+        values = np.full((len(keyframes), len(columns)), np.nan)
+        for row, (_, levels) in enumerate(keyframes):
+            if row > 0:
+                values[row] = values[row - 1]
+            for key, value in levels.items():
+                values[row, columns[key]] = value
+
+        return cls(list(columns), [t for t, _ in keyframes], values, loop_start)
+
+    def keyframes(self) -> List[Tuple[float, Dict]]:
+        frames = []
+        for t, row in zip(self.times, self.values):
+            frames.append((float(t), {k: v for k, v in zip(self.keys, row) if not math.isnan(v)}))
+        return frames
+
+    def get_duration(self) -> float:
+        return math.inf if self.loop_start is not None else self.end
+
+    def values_at(self, offset: float) -> np.ndarray:
+        """Returns the level of every key `offset` seconds into the timeline.
+
+        The returned array is reused by the next call.
+        """
+        if self.loop_start is not None and offset > self.end:
+            span = self.end - self.loop_start
+            offset = self.loop_start + ((offset - self.loop_start) % span if span > 0 else 0.0)
+
+        last = len(self.times) - 1
+        index = min(max(int(np.searchsorted(self.times, offset, side='right')) - 1, 0), last)
+        if index == last:
+            self.out[:] = self.values[last]
+            return self.out
+
+        progress = (offset - self.times[index]) / (self.times[index + 1] - self.times[index])
+        np.subtract(self.values[index + 1], self.values[index], out=self.out)
+        self.out *= progress
+        self.out += self.values[index]
+        return self.out
+
+    def instantiate(self) -> 'Timeline':
+        """Returns a timeline sharing these keyframes with its own output buffer."""
+        timeline = copy.copy(self)
+        timeline.out = np.empty_like(self.out)
+        return timeline
+
+    def as_levels(self, values: np.ndarray) -> Dict:
+        return {k: int(math.floor(v)) for k, v in zip(self.keys, values) if not math.isnan(v)}
+
 
 class Displayable(object):
+    # When True the keys of the timeline are pins rather than channel labels.
+    keyed_by_pin = False
+    # When True the levels can be changed while the displayable is running.
+    retargetable = False
+    # When True the displayable writes its levels to the hardware itself
+    # instead of through the timeline.
+    direct_output = False
 
     def __init__(self, repeats):
-        self.step = 0
         self.total_steps = repeats
         self.repeats_forever = (repeats <= 0)
+        self.start_time: float = None
+        self.timeline: Timeline = Timeline([], [0.0], [])
 
-    def increment_step(self):
-        self.step = self.step + 1
+    def instantiate(self) -> 'Displayable':
+        """Returns a copy of this displayable that can be started on its own.
 
-    def reset_step(self):
-        self.step = 0
+        Compiled parts such as the keyframes and child displayables are shared
+        with the copy and must not be changed in place.
+        """
+        instance = copy.copy(self)
+        instance.start_time = None
+        instance.timeline = self.timeline.instantiate()
+        return instance
 
-    def start(self, channels) -> asyncio.Task:
-        return asyncio.ensure_future(self.display(channels))
+    def start(self, channels):
+        self.start_time = time.monotonic()
 
     def stop(self):
         pass
 
     def get_first_levels(self):
-        return {}
+        return self.levels_at(0.0)
 
     def get_current_levels(self):
-        return {}
-
-    async def display(self, channels):
-        try:
-            while self.repeats_forever or self.step < self.total_steps:
-                await self.display_step(channels)
-                self.increment_step()
-        except CancelledError:
-            raise CancelledError
-        except KeyboardInterrupt:
-            raise KeyboardInterrupt
-        finally:
-            self.reset_step()
-
-    @abstractmethod
-    async def display_step(self, channels):
-        pass
+        if self.start_time is None:
+            return self.get_first_levels()
+        return self.levels_at(time.monotonic() - self.start_time)
+
+    def get_duration(self) -> float:
+        """Returns the length in seconds of a single repetition."""
+        return self.timeline.get_duration()
+
+    def get_total_duration(self) -> float:
+        if self.repeats_forever:
+            return math.inf
+        return self.get_duration() * self.total_steps
+
+    def is_finished(self, now: float) -> bool:
+        return now - self.start_time >= self.get_total_duration()
+
+    def values_at(self, elapsed: float) -> np.ndarray:
+        """Returns the timeline values that should be displayed `elapsed`
+        seconds after the displayable was started, taking repeats into account.
+        """
+        duration = self.get_duration()
+        if duration <= 0 or elapsed >= self.get_total_duration():
+            return self.timeline.values_at(duration)
+        return self.timeline.values_at(elapsed % duration)
+
+    def levels_at(self, elapsed: float) -> Dict:
+        return self.timeline.as_levels(self.values_at(elapsed))
+
+    def retarget(self, levels: Dict[str, int], duration: float) -> Dict[str, int]:
+        """Fades from the current levels to the given ones over `duration`
+        seconds and holds them. Labels that are not given keep their current
+        level. Returns the levels that will be held.
+        """
+        if not self.retargetable:
+            raise InvalidUsage('Only levels and fade presets can be updated.')
+        for label, value in levels.items():
+            if not (0 <= value <= 100):
+                raise InvalidUsage('Level value not in range.')
+
+        now = time.monotonic()
+        values = self.values_at(now - self.start_time) if self.start_time is not None else self.values_at(0.0)
+        current = {k: float(v) for k, v in zip(self.timeline.keys, values) if not math.isnan(v)}
+        target = {k: int(math.floor(v)) for k, v in current.items()}
+        target.update(levels)
+
+        self.timeline = Timeline.from_keyframes([(0.0, current), (max(duration, 0.0), target)])
+        self.total_steps = 1
+        self.repeats_forever = False
+        self.start_time = now
+        return target
 
 
 class Levels(Displayable):
+    retargetable = True
+
     def __init__(self, levels: Dict[str, int]):
         super().__init__(repeats=1)
         self.levels: Dict[str, int] = levels
         for label, value in levels.items():
             if not (0 <= value <= 100):
                 raise InvalidUsage('Level value not in range.')
+        self.timeline = Timeline.from_keyframes([(0.0, levels)])
 
     def get_first_levels(self):
         return self.levels
 
     def get_current_levels(self):
-        return self.levels
+        if len(self.timeline.times) == 1:
+            return self.levels
+        return super().get_current_levels()
 
-    async def display_step(self, channels):
-        for label, value in self.levels.items():
-            for ch in channels:
-                if ch.label == label:
-                    hardware.set_pwm(ch.pin, value)
+    def retarget(self, levels: Dict[str, int], duration: float) -> Dict[str, int]:
+        self.levels = super().retarget(levels, duration)
+        return self.levels
 
 
 class Fade(Displayable):
+    retargetable = True
+
     def __init__(self, items: List[Levels], delay: int, repeats: int):
         super().__init__(repeats)
         self.items = items
         self.delay = delay
         self.repeats = repeats
-        self.current_levels: Levels = self.items[0]
+
+        # Fading between two identical levels takes no time, so repeated levels are collapsed
+        keyframes = [(0.0, items[0].levels)]
+        for item in items[1:]:
+            if item.levels != keyframes[-1][1]:
+                keyframes.append((len(keyframes) * max(delay, 0), item.levels))
+        self.timeline = Timeline.from_keyframes(keyframes)
 
     def get_first_levels(self):
         return self.items[0].levels
 
-    def get_current_levels(self):
-        return self.current_levels.levels
-
-    async def display_step(self, channels):
-        colors = deepcopy(self.items)
-
-        num_loops = len(colors) - 1
-        for i in range(0, num_loops, 1):
-            next_index = i + 1 if i < len(colors) - 1 else 0
-
-            self.current_levels = colors[i]
-            next_levels = colors[next_index]
-            delta_levels = dict()
-            num_changes = 0
-            for label, value in self.current_levels.levels.items():
-                delta_levels[label] = next_levels.levels[label] - value
-                num_changes = max(num_changes, abs(delta_levels[label]))
-
-            if num_changes == 0:
-                continue
-
-            color_fns = {}
-            for label, value in self.current_levels.levels.items():
-                color_fns[label] = Fade.__create_fade_fn(next_levels.levels[label], value, num_changes)
-
-            pause_time = self.delay / num_changes
-            for j in range(0, num_changes + 1):
-                for label in self.current_levels.levels:
-                    self.current_levels.levels[label] = color_fns[label](j)
-
-                await self.current_levels.display_step(channels)
-                await asyncio.sleep(pause_time)
-
-    @staticmethod
-    def __create_fade_fn(finish, start, num_changes):
-        delta = (finish - start) / num_changes
-        return lambda step: int(math.floor(float(start) + (delta * float(step))))
+    def retarget(self, levels: Dict[str, int], duration: float) -> Dict[str, int]:
+        # The fade stops cycling and settles on the new levels
+        target = super().retarget(levels, duration)
+        self.items = [Levels(target)]
+        self.repeats = 1
+        return target
 
 
 class Sequence(Displayable):
@@ -139,60 +250,119 @@ class Sequence(Displayable):
         self.items = items
         self.delay = delay
         self.repeats = repeats
-        self.current_item: Displayable = self.items[0]
 
-    def get_first_levels(self):
-        return self.items[0].get_first_levels()
-
-    def get_current_levels(self):
-        return self.current_item.get_current_levels()
-
-    async def display_step(self, channels):
+        # Levels are held for the sequence's delay, every other item runs to completion.
+        # An item that never finishes becomes the looping tail of the sequence.
+        keyframes: List[Tuple[float, Dict]] = []
+        loop_start: float = None
+        offset = 0.0
         for item in self.items:
-            self.current_item = item
-            await item.display(channels)
             if isinstance(item, Levels):
-                await asyncio.sleep(self.delay)
+                keyframes += [(offset, item.levels), (offset + self.delay, item.levels)]
+                offset += self.delay
+                continue
+
+            item_keyframes = item.timeline.keyframes()
+            if item.get_total_duration() == math.inf:
+                keyframes += [(offset + t, levels) for t, levels in item_keyframes]
+                if item.timeline.loop_start is not None:
+                    loop_start = offset + item.timeline.loop_start
+                else:
+                    loop_start = offset
+                break
+
+            for _ in range(item.total_steps):
+                keyframes += [(offset + t, levels) for t, levels in item_keyframes]
+                offset += item.get_duration()
+
+        self.timeline = Timeline.from_keyframes(keyframes, loop_start)
+
+    def get_first_levels(self):
+        return self.items[0].get_first_levels()
 
 
 class VisualizerPreset(Displayable):
     def __init__(self, vis):
         super().__init__(repeats=1)
         self.visualizer = None
-        self.filter = None
-        for f in config.filters:
-            if f.name == vis['filter']:
-                self.filter = f
-        if self.filter is None:
-            self.filter = config.Filter(None)
+        self.filter = config.get_filter(vis['filter'])
 
     def start(self, channels):
+        super().start(channels)
         if self.filter.custom_channel_frequencies != 0:
             num_frequency_bins = len(self.filter.custom_channel_frequencies) - 1
             if len(channels) != num_frequency_bins:
                 raise KeyError('This filter requires exactly ' + str(num_frequency_bins) + ' channels.')
-
-        AudioFifoProtocol.current_visualizer = Visualizer(channels, self.filter)
-        return None
+        if self.filter.audio_channel != MIX and self.filter.audio_channel not in range(config.audio.audio_channels):
+            raise KeyError('This filter reads audio channel ' + str(self.filter.audio_channel) + ' but the audio '
+                           'source has ' + str(config.audio.audio_channels) + ' channels.')
+
+        if protocols.worker is not None:
+            # Levels are computed by the worker process and read back from
+            # shared memory on every frame, keyed by pin.
+            self.keyed_by_pin = True
+            self.timeline = Timeline(list(protocols.worker.pins), [0.0], [protocols.worker.frame])
+            protocols.worker.start_visualizer(id(self), [c.pin for c in channels], self.filter.name)
+        else:
+            # The visualizer and its FFT are only imported once one is shown
+            from aurora.visualizer.visualizer import Visualizer, VisualizerHub
+            self.direct_output = True
+            if AudioFifoProtocol.visualizer_hub is None:
+                AudioFifoProtocol.visualizer_hub = VisualizerHub()
+            AudioFifoProtocol.visualizer_hub.add(id(self), Visualizer(channels, self.filter))
 
     def stop(self):
-        AudioFifoProtocol.current_visualizer = None
+        if protocols.worker is not None:
+            protocols.worker.stop_visualizer(id(self))
+        elif AudioFifoProtocol.visualizer_hub is not None:
+            AudioFifoProtocol.visualizer_hub.remove(id(self))
 
-    async def display(self, channels: List[Channel]):
-        pass
+    def get_total_duration(self):
+        if protocols.worker is not None:
+            return math.inf
+        return super().get_total_duration()
 
-    async def display_step(self, channels):
-        pass
+    def values_at(self, elapsed):
+        if protocols.worker is not None:
+            return protocols.worker.frame
+        return super().values_at(elapsed)
+
+
+def factory(p: Dict[str, any]) -> Displayable:
+    """Returns a new displayable for the given payload, ready to be started.
+
+    Payloads are compiled once into a template that is kept in an LRU cache
+    keyed by a hash of the canonical JSON of the payload. Posting the same
+    payload again only copies the template.
+    """
+    global cache_hits, cache_misses
+
+    try:
+        canonical = json.dumps(p, sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        raise InvalidUsage('Preset payload format is invalid.')
+    key = hashlib.sha1(canonical.encode()).digest()
+
+    template = templates.get(key)
+    if template is None:
+        cache_misses += 1
+        template = compile_payload(p)
+        templates[key] = template
+        if len(templates) > template_cache_size:
+            templates.popitem(last=False)
+    else:
+        cache_hits += 1
+        templates.move_to_end(key)
 
+    return template.instantiate()
 
-def factory(p: Dict[str, any], nested=False) -> Displayable:
-    payload = deepcopy(p)
 
+def compile_payload(payload: Dict[str, any], nested=False) -> Displayable:
     try:
         # when repeats is set to -1 the displayable should loop forever
         # if no repeat amount is specified it will default to 1 unless it is the root
         repeats = -1 if not nested else 1
-        repeats = p['repeats'] if 'repeats' in p else repeats
+        repeats = payload['repeats'] if 'repeats' in payload else repeats
 
         disp_type = payload['type'].lower()
 
@@ -202,19 +372,33 @@ def factory(p: Dict[str, any], nested=False) -> Displayable:
         elif disp_type == 'fade':
             items: List[Levels] = []
             for sub in payload['children']:
-                sub_disp = factory(sub, True)
+                sub_disp = compile_payload(sub, True)
                 if type(sub_disp) is Levels:
                     items.append(sub_disp)
+            if len(items) == 0:
+                raise InvalidUsage('A fade needs at least one levels child.')
             return Fade(items, payload['delay'], repeats)
 
         elif disp_type == 'sequence':
             items: List[Displayable] = []
             for sub in payload['children']:
-                items.append(factory(sub, True))
+                items.append(compile_payload(sub, True))
+            if len(items) == 0:
+                raise InvalidUsage('A sequence needs at least one child.')
             return Sequence(items, payload['delay'], repeats)
 
         elif disp_type == 'visualizer':
             return VisualizerPreset(payload['visualizer'])
 
-    except KeyError:
+    except (KeyError, TypeError, AttributeError):
         raise InvalidUsage('Preset payload format is invalid.')
+
+    raise InvalidUsage('Unknown payload type.')
+
+
+def get_template_counters() -> Dict[str, int]:
+    return {
+        'hits': cache_hits,
+        'misses': cache_misses,
+        'size': len(templates),
+    }
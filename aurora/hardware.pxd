@@ -0,0 +1,27 @@
+cimport cython
+
+cdef object backend, hardware_config
+cdef int MAX_PINS, table_steps
+cdef int[:] shadow, table_rows
+cdef double[:, :] tables
+cdef double[:] pin_levels, residuals
+cdef bint dithering
+cdef unsigned long long call_count, level_count, write_count
+
+cdef extern from "math.h":
+    cpdef double rint(double x)
+
+cdef void _remember(int pin, int level)
+@cython.locals(row=int, index=Py_ssize_t, value=double)
+cdef int _correct(int pin, double level) except? -1
+# Errors of the backend must reach the caller, as they do uncompiled
+cdef void _set(int pin, double level) except *
+cdef void _write(int pin, int value) except *
+
+cpdef set_pwm(int pin, double level)
+
+@cython.locals(pin_view='const int[:]', level_view='const double[:]', i=Py_ssize_t)
+cpdef set_levels(pins, levels)
+
+@cython.locals(pin=int)
+cpdef dither()
@@ -0,0 +1,180 @@
+from typing import List
+import cython
+import numpy as np
+from aurora import correction, outputs
+from aurora.configuration import get_config
+
+# This module is compiled by Cython with the declarations in hardware.pxd
+# and runs as plain Python when it hasn't been built.
+
+# Compiled, rint is the C function declared in hardware.pxd
+if not cython.compiled:
+    from numpy import rint
+
+hardware_config = get_config().hardware
+
+# Where the levels are sent, selected by the output option
+backend = outputs.create_backend(hardware_config.output)
+
+# Largest pin number + 1 that has its output state shadowed.
+# Writes to pins outside of this range are always passed through.
+MAX_PINS = 64
+
+# Last value written to each pin, -1 when the value is unknown.
+shadow = np.full(MAX_PINS, -1, dtype=np.intc)
+
+# The lookup table row of each configured pin and the tables that map
+# levels from 0 to 100 onto the values of the backend, see correction.py
+table_rows, tables = correction.build_tables(hardware_config.channels, hardware_config,
+                                             backend.max_level)
+table_steps = correction.STEPS_PER_LEVEL
+
+# Last level set on each configured pin, -1 when it is unknown, and the part
+# of the value each pin is owed when dithering.
+pin_levels = np.full(table_rows.shape[0], -1, dtype=np.float64)
+residuals = np.zeros(table_rows.shape[0], dtype=np.float64)
+dithering = hardware_config.dithering
+
+# Number of calls to set_pwm and set_levels, number of levels those calls
+# carried, and number of levels that were actually written to a pin.
+call_count = 0
+level_count = 0
+write_count = 0
+
+
+def get_backend() -> outputs.OutputBackend:
+    return backend
+
+
+def set_backend(new_backend: outputs.OutputBackend):
+    """Sends all further levels to `new_backend`. The levels it shows are
+    unknown, so every pin is written again on its next update.
+    """
+    global backend, table_rows, tables
+    if new_backend.max_level != backend.max_level:
+        table_rows, tables = correction.build_tables(hardware_config.channels, hardware_config,
+                                                     new_backend.max_level)
+    backend = new_backend
+    shadow[:] = -1
+
+
+def enable(pins: List[int]):
+    backend.enable(pins)
+    for pin in pins:
+        _remember(pin, 0)
+
+
+def disable(pins: List[int]):
+    backend.disable(pins)
+    for pin in pins:
+        _remember(pin, -1)
+
+
+def _remember(pin, level):
+    if 0 <= pin < MAX_PINS:
+        shadow[pin] = level
+    if 0 <= pin < pin_levels.shape[0]:
+        pin_levels[pin] = level
+        residuals[pin] = 0
+
+
+def _correct(pin, level):
+    """Returns the value of the backend that shows `level` on `pin`."""
+    row = table_rows[pin] if 0 <= pin < table_rows.shape[0] else 0
+    index = int(rint(min(max(level, 0.0), 100.0) * table_steps))
+    value = tables[row, index]
+    if dithering and 0 <= pin < residuals.shape[0]:
+        # The rounding error is carried over to the next frame, so over a
+        # few frames the pin shows the exact value on average
+        value += residuals[pin]
+        residuals[pin] = value - rint(value)
+    return int(rint(value))
+
+
+def _set(pin, level):
+    global level_count
+    level_count += 1
+    if 0 <= pin < pin_levels.shape[0]:
+        pin_levels[pin] = level
+    _write(pin, _correct(pin, level))
+
+
+def _write(pin, value):
+    global write_count
+    if 0 <= pin < MAX_PINS:
+        if shadow[pin] == value:
+            return
+        shadow[pin] = value
+    write_count += 1
+    backend.write(pin, value)
+
+
+def set_pwm(pin, level):
+    global call_count
+    call_count += 1
+    _set(pin, level)
+    backend.flush()
+
+
+def set_levels(pins, levels):
+    """Sets pins[i] to levels[i] for every pin in a single call.
+
+    Both arguments may be any sequence or buffer of numbers, e.g. NumPy
+    arrays or memoryviews. Levels go from 0 to 100 and may have fractions.
+    They are corrected for the device of each pin and scaled to the values
+    of the backend. Pins that already show the resulting value are not
+    written again.
+    """
+    global call_count
+    pin_view = np.asarray(pins, dtype=np.intc)
+    level_view = np.asarray(levels, dtype=np.float64)
+
+    if pin_view.shape[0] != level_view.shape[0]:
+        raise ValueError('pins and levels must be the same length.')
+
+    call_count += 1
+    for i in range(pin_view.shape[0]):
+        _set(int(pin_view[i]), float(level_view[i]))
+    backend.flush()
+
+
+def dither():
+    """Writes every configured pin again with its dithered value. Called
+    once per frame when dithering is enabled, so that levels between two
+    values keep alternating between them.
+    """
+    if not dithering:
+        return
+    for pin in range(pin_levels.shape[0]):
+        if pin_levels[pin] >= 0:
+            _set(pin, pin_levels[pin])
+    backend.flush()
+
+
+def get_levels(pins: List[int]) -> List[float]:
+    """Returns the last level set on each of the given pins, -1 when it
+    is unknown.
+    """
+    return [float(pin_levels[pin]) if 0 <= pin < pin_levels.shape[0] else -1.0 for pin in pins]
+
+
+def get_counters():
+    """Returns the number of write calls made to this module, the number of
+    levels they carried and how many of those reached the hardware, along
+    with the counters of the output backend.
+    """
+    counters = {
+        'calls': call_count,
+        'levels': level_count,
+        'writes': write_count,
+        'skipped': level_count - write_count,
+    }
+    counters.update(backend.get_counters())
+    return counters
+
+
+def reset_counters():
+    global call_count, level_count, write_count
+    call_count = 0
+    level_count = 0
+    write_count = 0
@@ -1,19 +1,363 @@
-from typing import List
+import asyncio
+import json
+import math
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from aurora import hardware
-from aurora.configuration import Channel, Configuration
+import numpy as np
+
+from aurora import hardware, metrics
+from aurora.configuration import Channel, Configuration, get_config
+from aurora.displayables import Levels
 from aurora.preset import Preset
-from aurora.transition import TransitionPreset
 
-config: Configuration = Configuration()
-presets: List[Preset] = []
+
+class Compositor(object):
+    """Displays every running preset from a single fixed-rate loop.
+
+    On each tick the compositor asks the displayable of every active preset
+    for its timeline values at the current time, writes them into one frame
+    buffer indexed by channel and then flushes the changed pins to the hardware.
+    Presets whose displayable has finished are dropped from the loop but
+    their last levels stay in the frame. Live levels sent by clients are
+    collected in a pending buffer where the latest level of each channel
+    wins, and are written into the frame once per tick. Levels keep their
+    fractions until the hardware maps them onto its range. When nothing is
+    animating the loop sleeps until a preset is added or a channel is written,
+    unless the hardware is dithering.
+
+    Transitions between presets are crossfades of single channels. A channel
+    that crossfades is shown blended from the level it had when the crossfade
+    started to whatever is rendered into the frame for it, so the new preset
+    may animate while it fades in. Each channel keeps its own start level,
+    start time and duration, so starting another crossfade on a channel
+    only overwrites those and the channel continues from where it is.
+    """
+
+    def __init__(self, channels: List[Channel], frame_rate: float):
+        self.period: float = 1.0 / frame_rate
+        self.pins = np.array([c.pin for c in channels], dtype=np.int32)
+        self.indices: Dict[int, int] = {c.pin: i for i, c in enumerate(channels)}
+        self.frame = np.zeros(len(channels), dtype=np.float64)
+        self.dirty = np.zeros(len(channels), dtype=bool)
+        self.slots = np.full(max(self.pins) + 1, -1, dtype=np.intp)
+        self.slots[self.pins] = np.arange(len(channels))
+        self.live = np.full(len(channels), -1, dtype=np.float64)
+        self.has_live = False
+        self.output = np.zeros(len(channels), dtype=np.float64)
+        self.fading = np.zeros(len(channels), dtype=bool)
+        self.fade_from = np.zeros(len(channels), dtype=np.float64)
+        self.fade_start = np.zeros(len(channels), dtype=np.float64)
+        self.fade_duration = np.ones(len(channels), dtype=np.float64)
+        self.layers: Dict[int, Tuple[Preset, np.ndarray, np.ndarray]] = {}
+        self.wakeup: asyncio.Event = None
+        self.frames_skipped = 0
+
+    def add(self, preset: Preset):
+        """Starts rendering the given preset on the next tick. Channels of
+        the preset that the displayable has no levels for are set to off.
+        """
+
+        displayable = preset.displayable
+        columns = []
+        indices = []
+        for channel in preset.channels:
+            index = self.indices[channel.pin]
+            key = channel.pin if displayable.keyed_by_pin else channel.label
+            if key in displayable.timeline.columns:
+                columns.append(displayable.timeline.columns[key])
+                indices.append(index)
+            elif displayable.direct_output:
+                # The compositor must leave the channel alone
+                self.fading[index] = False
+            else:
+                self.frame[index] = 0
+                self.dirty[index] = True
+
+        self.layers[preset.id] = (preset, np.array(indices, dtype=np.intp), np.array(columns, dtype=np.intp))
+        self._wake()
+
+    def remove(self, preset: Preset):
+        self.layers.pop(preset.id, None)
+
+    def blank(self, channels: List[Channel]):
+        """Sets the given channels to off on the next tick."""
+
+        for channel in channels:
+            index = self.indices[channel.pin]
+            self.frame[index] = 0
+            self.dirty[index] = True
+        self._wake()
+
+    def crossfade(self, channels: List[Channel], duration: float):
+        """Fades the given channels from the level they show now to the
+        levels rendered for them from the next tick on, over `duration` seconds.
+        """
+        if duration <= 0 or len(channels) == 0:
+            return
+
+        indices = np.array([self.indices[c.pin] for c in channels], dtype=np.intp)
+        shown = hardware.get_levels(self.pins[indices].tolist())
+        self.fade_from[indices] = np.maximum(shown, 0)
+        self.fade_start[indices] = time.monotonic()
+        self.fade_duration[indices] = duration
+        self.fading[indices] = True
+        self._wake()
+
+    def set_live(self, pins, levels):
+        """Shows the given levels on the given pins on the next tick. Levels
+        set again before that tick replace the earlier ones and end any
+        crossfade on those pins.
+        """
+        self.live[self.slots[pins]] = levels
+        self.fading[self.slots[pins]] = False
+        self.has_live = True
+        self._wake()
+
+    def get_levels(self, channels: List[Channel]) -> Dict[str, int]:
+        """Returns the level rendered for each of the given channels on the
+        last tick by its label, ignoring crossfades.
+        """
+        return {c.label: int(math.floor(self.frame[self.indices[c.pin]])) for c in channels}
+
+    def tick(self, now: float) -> List[Preset]:
+        """Renders every layer into the frame. Returns the presets that finished."""
+
+        finished: List[Preset] = []
+        for preset, indices, columns in self.layers.values():
+            displayable = preset.displayable
+            values = displayable.values_at(now - displayable.start_time)[columns]
+            written = ~np.isnan(values)
+            self.frame[indices[written]] = values[written]
+            self.dirty[indices[written]] = True
+            if displayable.is_finished(now):
+                finished.append(preset)
+
+        if self.has_live:
+            written = self.live >= 0
+            self.frame[written] = self.live[written]
+            self.dirty |= written
+            self.live[:] = -1
+            self.has_live = False
+
+        self.output[self.dirty] = self.frame[self.dirty]
+        if self.fading.any():
+            self.blend(now)
+
+        for preset in finished:
+            self.remove(preset)
+        return finished
+
+    def blend(self, now: float):
+        """Writes the crossfading channels into the output and ends the
+        crossfades that are complete.
+        """
+        fading = np.flatnonzero(self.fading)
+        progress = np.minimum((now - self.fade_start[fading]) / self.fade_duration[fading], 1.0)
+        start = self.fade_from[fading]
+        self.output[fading] = start + (self.frame[fading] - start) * progress
+        self.dirty[fading] = True
+        self.fading[fading[progress >= 1.0]] = False
+
+    def flush(self):
+        if self.dirty.any():
+            hardware.set_levels(self.pins[self.dirty], self.output[self.dirty])
+            self.dirty[:] = False
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        deadline = time.monotonic()
+
+        while True:
+            if len(self.layers) == 0 and not self.dirty.any() and not self.has_live \
+                    and not self.fading.any() and not config.hardware.dithering:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                deadline = time.monotonic()
+
+            now = time.monotonic()
+            metrics.frame_lateness_seconds.observe(now - deadline)
+            finished = self.tick(now)
+            self.flush()
+            hardware.dither()
+            for preset in finished:
+                await preset.finish()
+
+            # If a tick ran late the missed frames are skipped, not replayed
+            now = time.monotonic()
+            if now > deadline + 2 * self.period:
+                self.frames_skipped += int((now - deadline) / self.period) - 1
+            deadline = max(deadline + self.period, now)
+            await asyncio.sleep(deadline - time.monotonic())
+
+    def _wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+
+class LevelFeed(object):
+    """Streams the level of every pin to any number of subscribers.
+
+    While anyone is subscribed a single task samples the levels the hardware
+    was last set to once per frame, encodes them once and offers them to
+    every subscriber. Each subscriber holds at most one waiting snapshot, so
+    a slow subscriber only ever gets the newest one and older snapshots are
+    dropped.
+    """
+
+    def __init__(self, channels: List[Channel], frame_rate: float):
+        self.period: float = 1.0 / frame_rate
+        self.pins: List[int] = [c.pin for c in channels]
+        self.subscribers: List[asyncio.Queue] = []
+        self.snapshot: Tuple[int, bytes, str] = None
+        self.revision = 0
+        self.dropped = 0
+        self.task: asyncio.Task = None
+
+    def subscribe(self) -> asyncio.Queue:
+        """Returns a queue that always holds the newest snapshot not yet taken
+        from it, as a (revision, binary, json) tuple.
+        """
+        queue = asyncio.Queue(maxsize=1)
+        self.subscribers.append(queue)
+        if self.snapshot is not None:
+            queue.put_nowait(self.snapshot)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.remove(queue)
+
+    def sample(self):
+        levels = bytes(max(0, min(int(round(level)), 255)) for level in hardware.get_levels(self.pins))
+        if self.snapshot is not None and self.snapshot[1] == levels:
+            return
+
+        self.revision += 1
+        self.snapshot = (self.revision, levels, json.dumps({'revision': self.revision, 'levels': list(levels)}))
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(self.snapshot)
+
+    async def run(self):
+        deadline = time.monotonic()
+        while len(self.subscribers) > 0:
+            self.sample()
+            deadline = max(deadline + self.period, time.monotonic())
+            await asyncio.sleep(deadline - time.monotonic())
+        self.snapshot = None
+
+
+class PresetRegistry(object):
+    """The running presets, indexed by id and by the pins they own.
+
+    Every pin is owned by at most one preset, so finding the presets that
+    conflict with a new one takes time proportional to the new preset's
+    channels. Presets iterate in the order they were added. The revision
+    is incremented whenever a preset is added, removed or changed.
+    """
+
+    def __init__(self):
+        self.by_id: Dict[int, Preset] = {}
+        self.owners: Dict[int, Preset] = {}
+        self.revision = 0
+        self.changed: asyncio.Event = None
+
+    def __iter__(self) -> Iterator[Preset]:
+        return iter(list(self.by_id.values()))
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, preset_id: int):
+        return preset_id in self.by_id
+
+    def get(self, preset_id: int) -> Optional[Preset]:
+        return self.by_id.get(preset_id)
+
+    def conflicts(self, channels: List[Channel]) -> List[Preset]:
+        """Returns the running presets that own any of the given channels."""
+
+        found: Dict[int, Preset] = {}
+        for channel in channels:
+            owner = self.owners.get(channel.pin)
+            if owner is not None:
+                found[owner.id] = owner
+        return list(found.values())
+
+    def replace(self, old_presets: List[Preset], new_presets: List[Preset]):
+        """Removes the old presets and adds the new ones in one step."""
+
+        for preset in old_presets:
+            self.by_id.pop(preset.id, None)
+            for channel in preset.channels:
+                if self.owners.get(channel.pin) is preset:
+                    del self.owners[channel.pin]
+
+        for preset in new_presets:
+            self.by_id[preset.id] = preset
+            for channel in preset.channels:
+                self.owners[channel.pin] = preset
+
+        if len(old_presets) > 0 or len(new_presets) > 0:
+            self.touch()
+
+    def add(self, preset: Preset):
+        self.replace([], [preset])
+
+    def remove(self, preset: Preset):
+        self.replace([preset], [])
+
+    def clear(self) -> List[Preset]:
+        """Removes every preset and returns them."""
+
+        removed = list(self.by_id.values())
+        self.by_id.clear()
+        self.owners.clear()
+        self.touch()
+        return removed
+
+    def touch(self):
+        """Marks the registry as changed."""
+
+        self.revision += 1
+        if self.changed is not None:
+            self.changed.set()
+            self.changed = None
+
+    async def wait(self, revision: int, timeout: float) -> bool:
+        """Waits up to `timeout` seconds for the registry to move past the
+        given revision. Returns whether it did.
+        """
+        if self.revision == revision:
+            if self.changed is None:
+                self.changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.revision != revision
+
+
+config: Configuration = get_config()
+presets: PresetRegistry = PresetRegistry()
+device_channels: Dict[str, List[Channel]] = {device: [c for c in config.hardware.channels if c.device == device]
+                                             for device in config.hardware.devices}
+compositor: Compositor = Compositor(config.hardware.channels, config.core.frame_rate)
+feed: LevelFeed = LevelFeed(config.hardware.channels, config.core.frame_rate)
+
+
+def get_transition_duration() -> float:
+    return config.core.transition_duration if config.core.enable_transitions else 0.0
 
 
 async def add_presets(new_presets: List[Preset]):
-    """Starts and adds each preset to the Global List."""
+    """Starts and adds each preset to the registry."""
 
-    for preset in new_presets:
-        presets.append(preset.start())
+    presets.replace([], [preset.start() for preset in new_presets])
 
 
 async def put_preset(new_preset: Preset):
@@ -26,31 +370,78 @@ async def put_presets(new_presets: List[Preset]):
     Checks whether the currently running presets are using channels that
     will be required by the new presets. If there are any conflicts the old
     preset will be stopped. Any channels that were used by a cancelled preset
-    that aren't used by a new preset are set to off.
+    that aren't used by a new preset are set to off. With transitions enabled
+    every channel crossfades from the level it shows to its new level.
 
     """
-    dropped_presets: List[Preset] = []
-    dropped_channels: List[Channel] = []
-    new_channels: List[Channel] = []
+    new_channels: List[Channel] = [channel for preset in new_presets for channel in preset.channels]
+    dropped_presets: List[Preset] = presets.conflicts(new_channels)
+    new_pins = {channel.pin for channel in new_channels}
+    dropped_channels: List[Channel] = [channel for preset in dropped_presets
+                                       for channel in preset.channels if channel.pin not in new_pins]
+
+    compositor.crossfade(new_channels + dropped_channels, get_transition_duration())
+    presets.replace(dropped_presets, [preset.start() for preset in new_presets])
+    for preset in dropped_presets:
+        await preset.stop()
 
-    for new_preset in new_presets:
-        for running_preset in presets:
+    compositor.blank(dropped_channels)
 
-            # If the new preset has needs a channel that is in use
-            if not set(running_preset.channels).isdisjoint(new_preset.channels):
-                dropped_presets.append(running_preset)
-                dropped_channels += set(running_preset.channels).difference(new_preset.channels)
 
-        new_channels += new_preset.channels
+def retarget_preset(preset: Preset, levels: Dict[str, int], duration: float = None):
+    """Changes the levels of a running levels or fade preset in place.
 
-    if config.core.enable_transitions:
-        new_presets = [TransitionPreset(dropped_presets, new_presets)]
+    The preset fades from its current levels to the new ones over `duration`
+    seconds, the transition duration by default. Nothing is stopped or
+    recreated, so this is cheap enough to call for every slider movement.
+    The payload is kept as it was created, the levels the preset now holds
+    are reported separately.
+    """
+    if duration is None:
+        duration = get_transition_duration()
 
-    await remove_presets(dropped_presets, ignore_dropped=True)
-    await add_presets(new_presets)
+    preset.levels = preset.displayable.retarget(levels, duration)
+    compositor.add(preset)
+    presets.touch()
 
-    for dropped_channel in dropped_channels:
-        hardware.set_pwm(dropped_channel.pin, 0)
+
+async def retarget_device(device: str, levels: Dict[str, int], duration: float = None) -> List[Preset]:
+    """Changes the levels of the given device.
+
+    When the device is entirely driven by levels or fade presets that don't
+    span other devices they are retargeted in place. Otherwise a new levels
+    preset is put on the device, replacing whatever was running on it.
+    Either way, labels that are not given keep their current level.
+    Returns the presets now showing the levels.
+    """
+    channels = device_channels[device]
+    owners = presets.conflicts(channels)
+    in_place = len(owners) > 0 \
+        and all(p.displayable.retargetable and p.devices == [device] for p in owners) \
+        and sum(len(p.channels) for p in owners) == len(channels)
+
+    if in_place:
+        for preset in owners:
+            retarget_preset(preset, levels, duration)
+        return owners
+
+    target = compositor.get_levels(channels)
+    target.update(levels)
+    preset = Preset(device, channels, {'type': 'levels', 'levels': target}, Levels(target))
+    await put_presets([preset])
+    return [preset]
+
+
+async def put_live_levels(channels: List[Channel], levels):
+    """Shows the levels on the channels from the next frame on, without
+    creating a preset. Running presets that use any of the channels are
+    removed so they don't overwrite the levels, the rest of their channels
+    keep their last level.
+    """
+    owners = presets.conflicts(channels)
+    if len(owners) > 0:
+        await remove_presets(owners, ignore_dropped=True)
+    compositor.set_live([c.pin for c in channels], levels)
 
 
 async def remove_presets(running_presets: List[Preset], ignore_dropped=False):
@@ -58,65 +449,36 @@ async def remove_presets(running_presets: List[Preset], ignore_dropped=False):
     off unless ignore_dropped=True.
     """
     dropped_channels: List[Channel] = []
-    cancelled_presets = running_presets.copy()
+    cancelled_presets = list(running_presets)
 
-    for preset in running_presets:
+    presets.replace(cancelled_presets, [])
+    for preset in cancelled_presets:
         await preset.stop()
         dropped_channels.extend(preset.channels)
-        presets.remove(preset)
 
     if not ignore_dropped:
-        if config.core.enable_transitions:
-            transition = TransitionPreset(cancelled_presets, [])
-            await add_presets([transition])
-        else:
-            for dropped_channel in dropped_channels:
-                hardware.set_pwm(dropped_channel.pin, 0)
+        compositor.crossfade(dropped_channels, get_transition_duration())
+        compositor.blank(dropped_channels)
 
 
 async def remove_presets_by_id(ids: List[int], ignore_dropped=False):
-    """Removes presets from the list with any of the given ids.
+    """Removes presets from the registry with any of the given ids.
     Sets dropped channels to off unless ignore_dropped=True.
     """
 
-    matching_presets = [x for x in presets if x.id in ids]
+    matching_presets = [presets.get(preset_id) for preset_id in ids if preset_id in presets]
     await remove_presets(matching_presets, ignore_dropped)
 
 
 async def clear_presets():
-    """Removes all presets from the list and sets their channels to off."""
+    """Removes all presets from the registry and sets their channels to off."""
 
     dropped_channels: List[Channel] = []
-    cancelled_presets = presets.copy()
+    cancelled_presets = presets.clear()
 
-    for preset in presets:
+    for preset in cancelled_presets:
         await preset.stop()
         dropped_channels.extend(preset.channels)
-        presets.remove(preset)
-
-    if config.core.enable_transitions:
-        transition = TransitionPreset(cancelled_presets, [])
-        await add_presets([transition])
-    else:
-        for dropped_channel in dropped_channels:
-            hardware.set_pwm(dropped_channel.pin, 0)
-    presets.clear()
-
-
-def _create_transition_presets(old_presets: List[Preset], new_presets: List[Preset]) -> List[TransitionPreset]:
-    transitions = []
-
-    if len(old_presets) > len(new_presets):
-        for old_preset in old_presets:
-            old_channels = set(old_preset.channels)
-            intersecting = [preset for preset in new_presets if not old_channels.isdisjoint(preset.channels)]
-            transitions.append(TransitionPreset([old_preset], intersecting))
-    else:
-        for new_preset in new_presets:
-            new_channels = set(new_preset.channels)
-            intersecting = [preset for preset in old_presets if not new_channels.isdisjoint(preset.channels)]
-            transitions.append(TransitionPreset(intersecting, [new_preset]))
-
-    return transitions
-
 
+    compositor.crossfade(dropped_channels, get_transition_duration())
+    compositor.blank(dropped_channels)
@@ -0,0 +1,13 @@
+cimport cython
+
+cdef class Histogram(object):
+
+    cdef:
+        public object name, description, bounds_array, counts_array
+        double[:] bounds
+        unsigned long long[:] counts
+        public unsigned long long count
+        public double sum
+
+    @cython.locals(i=Py_ssize_t)
+    cpdef observe(self, double value)
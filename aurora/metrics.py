@@ -0,0 +1,162 @@
+import asyncio
+import time
+from typing import List
+
+import numpy as np
+
+# This module is compiled by Cython with the declarations in metrics.pxd
+# and runs as plain Python when it hasn't been built.
+
+# Seconds between two runs of the event loop lag probe
+lag_probe_interval = 0.25
+
+
+class Histogram(object):
+    """Counts observed values in fixed buckets, in the format of a
+    Prometheus histogram.
+
+    The buckets are allocated once, observing a value only increments the
+    count of its bucket, the total count and the sum. Bucket i counts the
+    values up to bounds[i], the last bucket counts the values above every
+    bound.
+    """
+
+    def __init__(self, name: str, description: str, bounds: List[float]):
+        self.name = name
+        self.description = description
+        self.bounds_array = np.array(sorted(bounds), dtype=np.float64)
+        self.counts_array = np.zeros(len(bounds) + 1, dtype=np.ulonglong)
+        self.bounds = self.bounds_array
+        self.counts = self.counts_array
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        i = 0
+        while i < self.bounds.shape[0] and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+visualize_seconds = Histogram('aurora_visualize_seconds',
+                              'Time taken to visualize one chunk of audio.',
+                              [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1])
+fft_seconds = Histogram('aurora_fft_seconds',
+                        'Time taken to transform one chunk of audio.',
+                        [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05])
+audio_backlog_chunks = Histogram('aurora_audio_backlog_chunks',
+                                 'Chunks of audio waiting each time the audio source was read.',
+                                 [1, 2, 4, 8, 16, 32])
+frame_lateness_seconds = Histogram('aurora_frame_lateness_seconds',
+                                   'Time between when a frame of the compositor was due and when it was rendered.',
+                                   [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25])
+loop_lag_seconds = Histogram('aurora_event_loop_lag_seconds',
+                             'Time the event loop lag probe woke up later than it asked to.',
+                             [0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0])
+http_request_seconds = Histogram('aurora_http_request_seconds',
+                                 'Time taken to answer an HTTP request, without websockets and held requests.',
+                                 [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0])
+
+histograms: List[Histogram] = [visualize_seconds, fft_seconds, audio_backlog_chunks,
+                               frame_lateness_seconds, loop_lag_seconds, http_request_seconds]
+
+
+async def probe_loop_lag():
+    """Measures how late the event loop wakes up a sleeping task, i.e. how
+    long callbacks run without giving it back.
+    """
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(lag_probe_interval)
+        loop_lag_seconds.observe(max(0.0, time.monotonic() - start - lag_probe_interval))
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def add_sample(lines: List[str], name: str, kind: str, description: str, value):
+    lines.append('# HELP ' + name + ' ' + description)
+    lines.append('# TYPE ' + name + ' ' + kind)
+    lines.append(name + ' ' + format_value(value))
+
+
+def add_histogram(lines: List[str], histogram: Histogram):
+    name = histogram.name
+    lines.append('# HELP ' + name + ' ' + histogram.description)
+    lines.append('# TYPE ' + name + ' histogram')
+    cumulative = np.cumsum(histogram.counts_array)
+    for bound, count in zip(histogram.bounds_array, cumulative):
+        lines.append(name + '_bucket{le="' + repr(float(bound)) + '"} ' + str(int(count)))
+    lines.append(name + '_bucket{le="+Inf"} ' + str(int(cumulative[-1])))
+    lines.append(name + '_sum ' + repr(float(histogram.sum)))
+    lines.append(name + '_count ' + str(int(histogram.count)))
+
+
+def render() -> str:
+    """Returns every metric of the server in the Prometheus text format."""
+    # Imported here since these modules record into this one
+    from aurora import cluster, displayables, hardware, lights, protocols
+
+    lines: List[str] = []
+    for histogram in histograms:
+        add_histogram(lines, histogram)
+
+    add_sample(lines, 'aurora_presets', 'gauge', 'Presets that are running.', len(lights.presets))
+    add_sample(lines, 'aurora_crossfading_channels', 'gauge', 'Channels that are crossfading.',
+               int(lights.compositor.fading.sum()))
+    add_sample(lines, 'aurora_compositor_layers', 'gauge', 'Presets the compositor is animating.',
+               len(lights.compositor.layers))
+    add_sample(lines, 'aurora_frames_skipped_total', 'counter',
+               'Frames of the compositor that were skipped because a frame ran late.',
+               lights.compositor.frames_skipped)
+
+    hub = protocols.AudioFifoProtocol.visualizer_hub
+    add_sample(lines, 'aurora_visualizers', 'gauge', 'Visualizers that are running in this process.',
+               0 if hub is None else len(hub))
+
+    # The audio source lives in the visualizer process when there is one
+    source = protocols.fifo_protocol or protocols.tap_reader
+    if source is not None:
+        counters = source.get_counters()
+        if 'bytes_received' in counters:
+            add_sample(lines, 'aurora_fifo_bytes_total', 'counter', 'Bytes of audio read from the FIFO.',
+                       counters['bytes_received'])
+        add_sample(lines, 'aurora_audio_chunks_total', 'counter', 'Chunks of audio read.',
+                   counters['chunks_emitted'])
+        add_sample(lines, 'aurora_audio_chunks_dropped_total', 'counter',
+                   'Chunks of audio that were not shown, because they were stale or overwritten.',
+                   counters['chunks_dropped'])
+        add_sample(lines, 'aurora_audio_overruns_total', 'counter',
+                   'Reads that found a full ring, i.e. audio arrived faster than it was visualized.',
+                   counters['overruns'])
+
+    counters = hardware.get_counters()
+    add_sample(lines, 'aurora_hardware_calls_total', 'counter', 'Calls that set the levels of the lights.',
+               counters.pop('calls'))
+    add_sample(lines, 'aurora_hardware_levels_total', 'counter', 'Levels carried by those calls.',
+               counters.pop('levels'))
+    add_sample(lines, 'aurora_hardware_writes_total', 'counter', 'Levels written to the output.',
+               counters.pop('writes'))
+    add_sample(lines, 'aurora_hardware_skipped_total', 'counter', 'Levels not written since they were shown already.',
+               counters.pop('skipped'))
+    for key, value in counters.items():
+        add_sample(lines, 'aurora_output_' + key, 'untyped', 'Counter of the output backend.', value)
+
+    counters = displayables.get_template_counters()
+    add_sample(lines, 'aurora_template_hits_total', 'counter', 'Payloads found in the template cache.',
+               counters['hits'])
+    add_sample(lines, 'aurora_template_misses_total', 'counter', 'Payloads compiled into the template cache.',
+               counters['misses'])
+    add_sample(lines, 'aurora_templates', 'gauge', 'Templates in the template cache.', counters['size'])
+
+    if cluster.follower is not None:
+        for key, value in cluster.follower.get_counters().items():
+            add_sample(lines, 'aurora_cluster_' + key + '_total', 'counter', 'Counter of the cluster follower.', value)
+
+    lines.append('')
+    return '\n'.join(lines)
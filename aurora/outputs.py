@@ -0,0 +1,329 @@
+import asyncio
+import socket
+import struct
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Dict, List, Tuple
+
+from aurora.configuration import get_config
+
+config = get_config()
+
+# Number of slots in a DMX universe
+UNIVERSE_SIZE = 512
+
+# Default UDP ports of the network protocols
+SACN_PORT = 5568
+ARTNET_PORT = 6454
+
+# Largest value of a DMX slot
+DMX_MAX = 255
+
+
+class OutputBackend(ABC):
+    """Where the hardware module sends the levels of the lights.
+
+    write is called once for every value that changed, with a value from 0
+    to max_level. The hardware module maps levels onto that range. flush is
+    called once all values of a frame have been written, backends that send
+    whole frames do so there. Backends that must repeat the last frame while
+    nothing changes set refresh_interval to the number of seconds between
+    repeats.
+    """
+    refresh_interval: float = 0
+    max_level: int = 100
+
+    def enable(self, pins: List[int]):
+        pass
+
+    def disable(self, pins: List[int]):
+        pass
+
+    @abstractmethod
+    def write(self, pin: int, level: int):
+        pass
+
+    def flush(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def get_counters(self) -> Dict[str, int]:
+        return {}
+
+
+class WiringPiBackend(OutputBackend):
+    """Drives the pins of the Raspberry Pi with software PWM."""
+
+    def __init__(self, pwm_range: int):
+        import wiringpi
+        self.wiringpi = wiringpi
+        self.wiringpi.wiringPiSetup()
+        self.max_level = pwm_range
+
+    def enable(self, pins: List[int]):
+        for pin in pins:
+            self.wiringpi.softPwmCreate(pin, 0, self.max_level)
+
+    def disable(self, pins: List[int]):
+        for pin in pins:
+            self.wiringpi.softPwmWrite(pin, 0)
+            self.wiringpi.softPwmStop(pin)
+
+    def write(self, pin: int, level: int):
+        self.wiringpi.softPwmWrite(pin, level)
+
+
+class RecordingBackend(OutputBackend):
+    """Keeps the levels in memory instead of showing them, for tests and
+    benchmarks that run without lights.
+
+    levels holds the current level of every pin that was written. Every
+    flush that wrote something appends a (time.monotonic(), pins, levels)
+    tuple to frames, at most `limit` frames are kept.
+    """
+
+    def __init__(self, limit: int = 10000):
+        self.levels: Dict[int, int] = {}
+        self.frames: deque = deque(maxlen=limit)
+        self.pending_pins: List[int] = []
+        self.pending_levels: List[int] = []
+        self.frame_count = 0
+
+    def enable(self, pins: List[int]):
+        for pin in pins:
+            self.levels[pin] = 0
+
+    def disable(self, pins: List[int]):
+        for pin in pins:
+            self.levels.pop(pin, None)
+
+    def write(self, pin: int, level: int):
+        self.levels[pin] = level
+        self.pending_pins.append(pin)
+        self.pending_levels.append(level)
+
+    def flush(self):
+        if len(self.pending_pins) == 0:
+            return
+        self.frames.append((time.monotonic(), tuple(self.pending_pins), tuple(self.pending_levels)))
+        self.frame_count += 1
+        self.pending_pins.clear()
+        self.pending_levels.clear()
+
+    def clear(self):
+        self.frames.clear()
+        self.frame_count = 0
+
+    def get_counters(self) -> Dict[str, int]:
+        return {'frames': self.frame_count}
+
+
+class Universe(object):
+    """The preallocated packet of one DMX universe. The slots are part of
+    the packet, so a frame is sent without building a new one.
+    """
+
+    def __init__(self, number: int, packet: bytearray, data_offset: int, sequence_offset: int, address):
+        self.number = number
+        self.packet = packet
+        self.data = memoryview(packet)[data_offset:]
+        self.sequence_offset = sequence_offset
+        self.address = address
+        self.sequence = 0
+        self.dirty = False
+        self.sent_at = 0.0
+
+    def next_sequence(self):
+        # Art-Net treats 0 as no sequence, so both protocols count from 1 to 255
+        self.sequence = self.sequence % 255 + 1
+        self.packet[self.sequence_offset] = self.sequence
+
+
+class NetworkBackend(OutputBackend):
+    """Sends the levels to remote DMX controllers over UDP.
+
+    Pins are DMX slots counted from 0 across consecutive universes, so
+    pin 512 is the first slot of the universe after the first one. Values
+    are DMX values from 0 to 255. On flush every
+    universe that changed is sent as a single datagram. Receivers drop a
+    source that goes quiet, so the last frame is repeated while nothing
+    changes.
+    """
+    refresh_interval = 1.0
+    max_level = DMX_MAX
+
+    def __init__(self, host: str, port: int, first_universe: int):
+        self.host = host
+        self.port = port
+        self.first_universe = first_universe
+        self.universes: Dict[int, Universe] = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setblocking(False)
+
+        self.packets_sent = 0
+        self.send_errors = 0
+
+    @abstractmethod
+    def build_packet(self, number: int, slots: int) -> Tuple[bytearray, int, int]:
+        """Returns the packet of a universe with `slots` slots, the offset of
+        its first slot and the offset of its sequence number.
+        """
+        pass
+
+    def get_address(self, number: int) -> Tuple[str, int]:
+        return self.host, self.port
+
+    def get_universe(self, pin: int) -> Universe:
+        number = self.first_universe + pin // UNIVERSE_SIZE
+        universe = self.universes.get(number)
+        if universe is None:
+            universe = self.add_universe(number, UNIVERSE_SIZE)
+        return universe
+
+    def add_universe(self, number: int, slots: int) -> Universe:
+        packet, data_offset, sequence_offset = self.build_packet(number, slots)
+        universe = Universe(number, packet, data_offset, sequence_offset, self.get_address(number))
+        self.universes[number] = universe
+        return universe
+
+    def enable(self, pins: List[int]):
+        # Each universe only carries the slots up to its highest pin
+        highest: Dict[int, int] = {}
+        for pin in pins:
+            number = self.first_universe + pin // UNIVERSE_SIZE
+            highest[number] = max(highest.get(number, 0), pin % UNIVERSE_SIZE)
+        for number, slot in highest.items():
+            if number not in self.universes:
+                # Sent with the first frame or refresh
+                self.add_universe(number, slot + 1).dirty = True
+
+    def disable(self, pins: List[int]):
+        for pin in pins:
+            self.write(pin, 0)
+        self.flush()
+
+    def write(self, pin: int, level: int):
+        universe = self.get_universe(pin)
+        slot = pin % UNIVERSE_SIZE
+        if slot >= len(universe.data):
+            # The pin was not enabled, grow the universe to its full size.
+            # Receivers drop packets whose sequence goes back, so it carries on.
+            previous = universe
+            universe = self.add_universe(previous.number, UNIVERSE_SIZE)
+            universe.data[:len(previous.data)] = previous.data
+            universe.sequence = previous.sequence
+            universe.dirty = True
+        value = max(0, min(level, DMX_MAX))
+        if universe.data[slot] != value:
+            universe.data[slot] = value
+            universe.dirty = True
+
+    def send(self, universe: Universe, now: float):
+        universe.next_sequence()
+        universe.dirty = False
+        universe.sent_at = now
+        try:
+            self.sock.sendto(universe.packet, universe.address)
+            self.packets_sent += 1
+        except OSError as e:
+            # The socket never blocks, a full send buffer or an unreachable
+            # network only costs this frame
+            self.send_errors += 1
+            if config.core.debug:
+                print('Network Output: Universe ' + str(universe.number) + ' not sent: ' + str(e))
+
+    def flush(self):
+        now = time.monotonic()
+        for universe in self.universes.values():
+            if universe.dirty:
+                self.send(universe, now)
+
+    def refresh(self):
+        now = time.monotonic()
+        for universe in self.universes.values():
+            if universe.dirty or now - universe.sent_at >= self.refresh_interval:
+                self.send(universe, now)
+
+    def get_counters(self) -> Dict[str, int]:
+        return {
+            'universes': len(self.universes),
+            'packets_sent': self.packets_sent,
+            'send_errors': self.send_errors,
+        }
+
+
+class SacnBackend(NetworkBackend):
+    """Sends E1.31 (streaming ACN) data packets, by default to the multicast
+    group of each universe.
+    """
+
+    def __init__(self, host: str, port: int, first_universe: int):
+        super().__init__(host, port or SACN_PORT, first_universe)
+        self.cid = uuid.uuid4().bytes
+        self.source_name = config.core.serverName.encode()[:63]
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+
+    def get_address(self, number: int) -> Tuple[str, int]:
+        if self.host:
+            return self.host, self.port
+        return '239.255.{}.{}'.format(number >> 8, number & 0xff), self.port
+
+    def build_packet(self, number: int, slots: int) -> Tuple[bytearray, int, int]:
+        length = 126 + slots
+        packet = bytearray(length)
+        # Root layer
+        struct.pack_into('!HH12sHI16s', packet, 0, 0x0010, 0x0000, b'ASC-E1.17\x00\x00\x00',
+                         0x7000 | (length - 16), 0x00000004, self.cid)
+        # Framing layer, the sequence number is at offset 111
+        struct.pack_into('!HI64sBHBBH', packet, 38, 0x7000 | (length - 38), 0x00000002,
+                         self.source_name, 100, 0, 0, 0, number)
+        # DMP layer, the start code is followed by the slots
+        struct.pack_into('!HBBHHHB', packet, 115, 0x7000 | (length - 115), 0x02, 0xa1,
+                         0x0000, 0x0001, slots + 1, 0x00)
+        return packet, 126, 111
+
+
+class ArtNetBackend(NetworkBackend):
+    """Sends ArtDmx packets, by default as broadcasts."""
+
+    def __init__(self, host: str, port: int, first_universe: int):
+        super().__init__(host or '255.255.255.255', port or ARTNET_PORT, first_universe)
+
+    def build_packet(self, number: int, slots: int) -> Tuple[bytearray, int, int]:
+        # The data length must be even
+        slots += slots % 2
+        packet = bytearray(18 + slots)
+        struct.pack_into('<8sH', packet, 0, b'Art-Net\x00', 0x5000)
+        # The sequence number is at offset 12, the 15 bit port address
+        # is split into the SubUni and Net bytes
+        struct.pack_into('!HBBBBH', packet, 10, 14, 0, 0, number & 0xff, (number >> 8) & 0x7f, slots)
+        return packet, 18, 12
+
+
+def create_backend(name: str) -> OutputBackend:
+    """Returns a new backend of the type set by the output option."""
+    hardware = config.hardware
+    if name == 'wiringpi':
+        return WiringPiBackend(hardware.pwm_range)
+    elif name == 'recording':
+        return RecordingBackend()
+    elif name == 'sacn':
+        first = hardware.universe if hardware.universe >= 0 else 1
+        return SacnBackend(hardware.output_host, hardware.output_port, first)
+    elif name == 'artnet':
+        first = hardware.universe if hardware.universe >= 0 else 0
+        return ArtNetBackend(hardware.output_host, hardware.output_port, first)
+    else:
+        raise ValueError('Unknown output backend: ' + str(name))
+
+
+async def keep_alive(backend: OutputBackend):
+    """Calls refresh on the backend every refresh_interval seconds."""
+    while True:
+        await asyncio.sleep(backend.refresh_interval / 2)
+        backend.refresh()
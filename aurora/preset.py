@@ -1,13 +1,12 @@
-import asyncio
 from typing import Dict, List, Set
 
 from sanic.exceptions import InvalidUsage
 
 from aurora import displayables, lights
-from aurora.configuration import Configuration, Channel
+from aurora.configuration import Channel, get_config
 from aurora.displayables import Displayable, Levels, Fade
 
-config = Configuration()
+config = get_config()
 
 
 class Preset(object):
@@ -21,7 +20,8 @@ class Preset(object):
         self.devices: List[str] = []
         self.payload: Dict = payload
         self.displayable: Displayable = displayable
-        self.task: asyncio.Task = None
+        # Levels the preset holds since it was retargeted, None until then
+        self.levels: Dict[str, int] = None
 
         # Generate affected devices
         for channel in self.channels:
@@ -62,26 +62,31 @@ class Preset(object):
         except KeyError:
             raise InvalidUsage('Invalid payload syntax.')
 
+    def instantiate(self) -> 'Preset':
+        """Returns a new preset with the same settings and its own copy of the displayable."""
+        return Preset(self.name, self.channels, self.payload, self.displayable.instantiate())
+
     def start(self):
-        self.task = self.displayable.start(self.channels)
+        self.displayable.start(self.channels)
+        lights.compositor.add(self)
         return self
 
     async def stop(self):
         self.displayable.stop()
-        if self.task is not None:
-            self.task.cancel()
-            try:
-                await self.task
-            except asyncio.CancelledError:
-                pass
-        else:
-            print('Warning: preset ' + str(self.id) + ' has no task to stop.')
+        lights.compositor.remove(self)
+
+    async def finish(self):
+        """Called by the compositor once the displayable has finished."""
+        pass
 
     def as_dict(self):
-        return {
+        d = {
             "id": self.id,
             "name": self.name,
             "channels": self.channels,
             "devices": self.devices,
             "payload": self.payload
-        }
\ No newline at end of file
+        }
+        if self.levels is not None:
+            d["levels"] = self.levels
+        return d
\ No newline at end of file
@@ -1,41 +1,88 @@
 import os
+import time
 import asyncio
 import aiofiles
-import alsaaudio
 import multiprocessing
-from aurora.configuration import Configuration
+from typing import Dict, List
+import numpy as np
+import uvloop
+from aurora import metrics
+from aurora.configuration import get_config
+from aurora.visualizer.decode import Decoder
 
-config = Configuration()
+config = get_config()
 debug = config.core.debug
 chunk_size = config.audio.chunk_size
+# Also checks the sample format and chunk size when the server starts
+decoder = Decoder.from_config(config.audio)
+ring_chunks = 32
+# The cursor of an AudioTap counts chunks modulo 2**32
+CURSOR_MASK = 0xffffffff
+backlog_chunks = config.audio.backlog_chunks
+worker: 'VisualizerWorker' = None
+# The audio source read by this process, if any
+fifo_protocol: 'AudioFifoProtocol' = None
+tap_reader: 'AudioTapReader' = None
 
 
 class AudioFifoProtocol(asyncio.BufferedProtocol):
-    current_visualizer = None
+    """Reads raw PCM from the audio FIFO into a preallocated ring buffer.
+
+    The event loop reads straight into the free space of the ring and each
+    complete chunk is handed to the visualizer hub as a memoryview into the ring,
+    so no audio bytes are copied or allocated per read. The ring holds a
+    whole number of chunks and chunks always start on a chunk boundary, so a
+    chunk never wraps around the end of the storage.
+    """
+    visualizer_hub = None
 
     def __init__(self):
         super().__init__()
         self.complete_event = asyncio.Event()
-        self.buffer = bytearray()
-        self.larger_buffer = bytearray()
+        self.storage = bytearray(chunk_size * ring_chunks)
+        self.view = memoryview(self.storage)
+        self.read_pos = 0
+        self.write_pos = 0
+
+        self.bytes_received = 0
+        self.chunks_emitted = 0
+        self.chunks_dropped = 0
+        self.overruns = 0
 
     def connection_made(self, transport):
         if debug:
             print('Audio FIFO Protocol: Connection Made')
 
     def get_buffer(self, sizehint):
-        self.buffer = bytearray(max(sizehint, chunk_size))
-        if len(self.buffer) < sizehint:
-            self.buffer.extend(0 for _ in range(sizehint - len(self.buffer)))
-        return self.buffer
+        # Less than a chunk is ever left unread, so when the end of the
+        # storage is reached the ring is empty and can start over.
+        if self.write_pos == len(self.storage):
+            self.read_pos = 0
+            self.write_pos = 0
+        return self.view[self.write_pos:]
 
     def buffer_updated(self, nbytes):
-        self.larger_buffer = self.larger_buffer + self.buffer[:nbytes]
-        while len(self.larger_buffer) >= chunk_size:
-            chunk = self.larger_buffer[:chunk_size]
-            del self.larger_buffer[:chunk_size]
-            if AudioFifoProtocol.current_visualizer is not None:
-                AudioFifoProtocol.current_visualizer.visualize(chunk)
+        self.write_pos += nbytes
+        self.bytes_received += nbytes
+
+        # A read that fills the whole ring means the FIFO was at least a ring
+        # behind, i.e. audio arrived faster than it could be visualized.
+        if self.write_pos - self.read_pos == len(self.storage):
+            self.overruns += 1
+
+        chunks = (self.write_pos - self.read_pos) // chunk_size
+        end = self.read_pos + chunks * chunk_size
+        self.chunks_dropped += visualize_chunks(self.view[self.read_pos:end], chunks)
+        self.chunks_emitted += chunks
+        self.read_pos = end
+
+    def get_counters(self):
+        return {
+            'bytes_received': self.bytes_received,
+            'chunks_emitted': self.chunks_emitted,
+            'chunks_dropped': self.chunks_dropped,
+            'overruns': self.overruns,
+        }
 
     def eof_received(self):
         if debug:
@@ -55,6 +102,140 @@ class AudioFifoProtocol(asyncio.BufferedProtocol):
             print('Audio FIFO Protocol: Writing Resumed')
 
 
+def visualize_chunks(view: memoryview, count: int) -> int:
+    """Hands `count` consecutive chunks held in `view` to the visualizer hub.
+
+    When more than backlogChunks chunks are waiting, the reader has fallen
+    behind and only the newest chunk is shown. The stale ones still feed the
+    visualizers' statistics in one batch. Returns the number of chunks that
+    were not shown.
+    """
+    hub = AudioFifoProtocol.visualizer_hub
+    if hub is None or len(hub) == 0 or count == 0:
+        return 0
+
+    metrics.audio_backlog_chunks.observe(count)
+    dropped = 0
+    if count > backlog_chunks:
+        dropped = count - 1
+        hub.catch_up(view[:dropped * chunk_size], dropped)
+
+    for i in range(dropped, count):
+        start = time.perf_counter()
+        hub.visualize(view[i * chunk_size:(i + 1) * chunk_size])
+        metrics.visualize_seconds.observe(time.perf_counter() - start)
+    return dropped
+
+
+class AudioTap(object):
+    """Ring of audio chunks in shared memory, written by the audio player
+    process and read by the visualizer.
+
+    The player copies every chunk it plays into the next slot together with
+    the monotonic time at which the chunk will be heard, then advances the
+    write cursor and writes a byte to the notification pipe. Readers keep
+    their own read cursor, so a reader that falls more than a ring behind
+    can tell how many chunks it has missed.
+
+    The cursor is 32 bits wide so that the other process never sees it half
+    written, which a 64 bit store allows on 32 bit ARM. It counts chunks
+    modulo 2**32, and the number of slots is a power of two so that the slot
+    of a chunk doesn't jump when the cursor wraps around.
+    """
+
+    def __init__(self, slots: int = ring_chunks):
+        if slots <= 0 or slots & (slots - 1) != 0:
+            raise ValueError('The number of slots must be a power of two.')
+        self.slots = slots
+        self.data = multiprocessing.RawArray('B', chunk_size * slots)
+        self.timestamps = multiprocessing.RawArray('d', slots)
+        self.cursor = multiprocessing.RawValue('I', 0)
+        # Only the file descriptors of the pipe are used. Connections can be
+        # handed to spawned processes, plain descriptors cannot.
+        self.notify_reader, self.notify_writer = multiprocessing.Pipe(duplex=False)
+        os.set_blocking(self.notify_writer.fileno(), False)
+
+    def publish(self, data: bytes, timestamp: float):
+        cursor = self.cursor.value
+        start = (cursor % self.slots) * chunk_size
+        view = memoryview(self.data).cast('B')
+        view[start:start + len(data)] = data
+        if len(data) < chunk_size:
+            view[start + len(data):start + chunk_size] = bytes(chunk_size - len(data))
+        self.timestamps[cursor % self.slots] = timestamp
+        self.cursor.value = (cursor + 1) & CURSOR_MASK
+        try:
+            os.write(self.notify_writer.fileno(), b'\0')
+        except BlockingIOError:
+            # The reader has plenty of wake ups queued already.
+            pass
+
+
+class AudioTapReader(object):
+    """Feeds the chunks published to an AudioTap to the visualizer hub.
+
+    Chunks are visualized straight out of shared memory. The light delay of
+    the visualizers follows how far in the future the newest chunk will be
+    heard, instead of the delay of their filters.
+    """
+
+    def __init__(self, tap: AudioTap):
+        self.tap = tap
+        self.view = memoryview(tap.data).cast('B')
+        self.read_cursor = tap.cursor.value
+        self.chunk_duration = decoder.get_chunk_duration()
+
+        self.chunks_emitted = 0
+        self.chunks_dropped = 0
+        self.overruns = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        os.set_blocking(self.tap.notify_reader.fileno(), False)
+        loop.add_reader(self.tap.notify_reader.fileno(), self.on_ready)
+
+    def on_ready(self):
+        try:
+            os.read(self.tap.notify_reader.fileno(), 4096)
+        except BlockingIOError:
+            pass
+
+        slots = self.tap.slots
+        cursor = self.tap.cursor.value
+        waiting = (cursor - self.read_cursor) & CURSOR_MASK
+        if waiting == 0:
+            return
+
+        if waiting >= slots:
+            # The player has overwritten chunks that were never read and
+            # writes the next one into the slot of the oldest chunk, which
+            # is skipped as well.
+            self.overruns += 1
+            self.chunks_dropped += waiting - (slots - 1)
+            waiting = slots - 1
+            self.read_cursor = (cursor - waiting) & CURSOR_MASK
+
+        hub = AudioFifoProtocol.visualizer_hub
+        if hub is not None:
+            latency = self.tap.timestamps[(cursor - 1) % slots] - time.monotonic()
+            hub.set_light_delay(max(0, int(round(latency / self.chunk_duration))))
+
+        while waiting > 0:
+            slot = self.read_cursor % slots
+            count = min(waiting, slots - slot)
+            view = self.view[slot * chunk_size:(slot + count) * chunk_size]
+            self.chunks_dropped += visualize_chunks(view, count)
+            self.chunks_emitted += count
+            self.read_cursor = (self.read_cursor + count) & CURSOR_MASK
+            waiting -= count
+
+    def get_counters(self):
+        return {
+            'chunks_emitted': self.chunks_emitted,
+            'chunks_dropped': self.chunks_dropped,
+            'overruns': self.overruns,
+        }
+
+
 def create_fifo(path):
     if os.path.exists(path):
         os.remove(path)
@@ -63,18 +244,31 @@ def create_fifo(path):
 
 
 async def read_fifo():
-    afp = AudioFifoProtocol()
-    loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
-
+    global worker, tap_reader
     fifo_path = config.audio.fifo_path
     create_fifo(fifo_path)
 
+    source = fifo_path
     if config.audio.play_audio:
-        fifo_path = '/tmp/aurora-fifo-chunked'
-        create_fifo('/tmp/aurora-fifo-chunked')
-        audio_player = multiprocessing.Process(target=play_audio)
+        source = AudioTap()
+        audio_player = multiprocessing.Process(target=play_audio, args=(source,))
         audio_player.start()
 
+    if config.audio.visualizer_process:
+        worker = VisualizerWorker(source)
+    elif isinstance(source, AudioTap):
+        tap_reader = AudioTapReader(source)
+        tap_reader.start(asyncio.get_event_loop())
+    else:
+        await connect_fifo(fifo_path)
+
+
+async def connect_fifo(fifo_path):
+    global fifo_protocol
+    afp = AudioFifoProtocol()
+    fifo_protocol = afp
+    loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+
     while True:
         afp.complete_event.clear()
         audio_fifo = await aiofiles.open(fifo_path, mode='r')
@@ -82,24 +276,160 @@ async def read_fifo():
         await afp.complete_event.wait()
 
 
-def play_audio():
+class SharedFrame(object):
+    """Visualizer output that writes levels into shared memory instead of to
+    the hardware. The frame has one slot per configured channel.
+    """
+
+    def __init__(self, shared):
+        self.frame = np.frombuffer(shared, dtype=np.float64)
+        pins = [c.pin for c in config.hardware.channels]
+        self.slots = np.full(max(pins) + 1, -1, dtype=np.intp)
+        for index, pin in enumerate(pins):
+            self.slots[pin] = index
+
+    def set_levels(self, pins, levels):
+        self.frame[self.slots[pins]] = levels
+
+
+class VisualizerWorker(object):
+    """Handle on a process that reads the audio FIFO, or the audio tap when
+    audio is played, and runs the visualizer.
+
+    The server only sends control messages (start and stop)
+    through a pipe. The worker writes the levels it computes into a shared
+    frame which the compositor reads on every tick.
+    """
+
+    def __init__(self, source):
+        context = multiprocessing.get_context('spawn')
+        self.pins: List[int] = [c.pin for c in config.hardware.channels]
+        self.shared = context.Array('d', len(self.pins), lock=False)
+        self.frame = np.frombuffer(self.shared, dtype=np.float64)
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=run_visualizer_worker,
+                                       args=(source, child_connection, self.shared,
+                                             config.audio.visualizer_cpu),
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def start_visualizer(self, key: int, pins: List[int], filter_name: str):
+        self.connection.send(('start', key, pins, filter_name))
+
+    def stop_visualizer(self, key: int):
+        self.connection.send(('stop', key))
+
+
+def run_visualizer_worker(source, connection, shared, cpu):
+    if cpu >= 0:
+        os.sched_setaffinity(0, {cpu})
+
+    from aurora.visualizer.visualizer import Visualizer, VisualizerHub
+
+    output = SharedFrame(shared)
+    hub = VisualizerHub()
+    AudioFifoProtocol.visualizer_hub = hub
+    loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Pins of each running visualizer
+    visualizers: Dict[int, List[int]] = {}
+
+    def on_message():
+        try:
+            message = connection.recv()
+        except EOFError:
+            # The server process has exited
+            loop.stop()
+            return
+
+        key = message[1]
+        if message[0] == 'start':
+            pins, filter_name = message[2], message[3]
+            visualizers[key] = pins
+            channels = [config.hardware.channels_dict[pin] for pin in pins]
+            hub.add(key, Visualizer(channels, config.get_filter(filter_name), output))
+        elif message[0] == 'stop' and key in visualizers:
+            hub.remove(key)
+            pins = visualizers.pop(key)
+            output.set_levels(pins, [0] * len(pins))
+
+    loop.add_reader(connection.fileno(), on_message)
+    if isinstance(source, AudioTap):
+        AudioTapReader(source).start(loop)
+    else:
+        loop.create_task(connect_fifo(source))
+    loop.run_forever()
+
+
+class AlsaSink(object):
+    """Plays audio on the default ALSA device."""
+
+    # Number of periods in the device buffer when the device does not report
+    # how much of it is filled.
+    periods = 4
+
+    def __init__(self):
+        import alsaaudio
+        self.device = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NORMAL)
+        self.device.setchannels(config.audio.audio_channels)
+        self.device.setrate(config.audio.sample_rate)
+        self.device.setformat(getattr(alsaaudio, 'PCM_FORMAT_' + decoder.sample_format))
+        self.period_frames = self.device.setperiodsize(config.audio.chunk_size) or config.audio.chunk_size
+
+    def write(self, data: bytes):
+        self.device.write(data)
+
+    def get_latency(self) -> float:
+        """Returns the number of seconds until audio written now is heard."""
+        buffer_frames = self.period_frames * self.periods
+        try:
+            queued_frames = buffer_frames - self.device.avail()
+        except AttributeError:
+            # pyalsaaudio < 0.10 can't tell, assume the buffer is full since
+            # write blocks until there is room.
+            queued_frames = buffer_frames
+        return max(0, queued_frames) / config.audio.sample_rate
+
+
+class NullSink(object):
+    """Discards audio at the rate it would be played, with a fixed latency."""
+
+    def __init__(self, latency: float = 0.0, realtime: bool = True):
+        self.latency = latency
+        self.realtime = realtime
+        self.bytes_per_second = decoder.bytes_per_frame * config.audio.sample_rate
+
+    def write(self, data: bytes):
+        if self.realtime:
+            time.sleep(len(data) / self.bytes_per_second)
+
+    def get_latency(self) -> float:
+        return self.latency
+
+
+def play_stream(stream, tap: AudioTap, sink):
+    """Plays the audio read from `stream` until it ends and publishes every
+    chunk to the tap with the time it will be heard.
+    """
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        sink.write(data)
+        tap.publish(data, time.monotonic() + sink.get_latency())
+
+
+def play_audio(tap: AudioTap, sink=None):
     fifo_in_path = config.audio.fifo_path
-    fifo_out_path = '/tmp/aurora-fifo-chunked'
-    output_device = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NORMAL)
-    output_device.setchannels(config.audio.audio_channels)
-    output_device.setrate(config.audio.sample_rate)
-    output_device.setformat(alsaaudio.PCM_FORMAT_S16_LE)
-    output_device.setperiodsize(config.audio.chunk_size)
+    if sink is None:
+        sink = AlsaSink()
     while True:
         try:
             print('Audio Player: Attempting connection...')
             with open(fifo_in_path, 'rb') as in_fifo:
                 print('Audio Player: Connected to source')
-                with open(fifo_out_path, 'wb') as out_fifo:
-                    print('Audio Player: Connected to sink')
-                    while True:
-                        data = in_fifo.read(config.audio.chunk_size)
-                        out_fifo.write(data)
-                        output_device.write(data)
+                play_stream(in_fifo, tap, sink)
         except IOError:
-            print('Audio Player: Connection lost')
+            pass
+        print('Audio Player: Connection lost')
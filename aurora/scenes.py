@@ -0,0 +1,118 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from sanic.exceptions import InvalidUsage
+
+from aurora import lights
+from aurora.configuration import get_config
+from aurora.preset import Preset
+
+config = get_config()
+
+
+class Scene(object):
+    """A named list of presets that can be shown with a single request.
+
+    The presets are compiled when the scene is loaded or saved, so
+    activating the scene only instantiates and starts them.
+    """
+
+    def __init__(self, name: str, presets: List[Dict]):
+        if not isinstance(presets, list) or len(presets) == 0:
+            raise InvalidUsage('A scene needs a list of at least one preset.')
+        self.name: str = name
+        self.presets: List[Dict] = presets
+        self.compiled: List[Preset] = [Preset.from_dictionary(p) for p in presets]
+
+    def instantiate(self) -> List[Preset]:
+        return [preset.instantiate() for preset in self.compiled]
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'presets': self.presets,
+        }
+
+
+class SceneStore(object):
+    """Scenes kept in a SQLite database on local disk.
+
+    Every scene is compiled in memory as well. Reads are served from memory,
+    writes go to the database on a single background thread so the event
+    loop never waits for the disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.scenes: Dict[str, Scene] = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.connection: sqlite3.Connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS scenes ('
+                                    'name TEXT PRIMARY KEY, presets TEXT NOT NULL, updated REAL NOT NULL)')
+            self.connection.commit()
+        return self.connection
+
+    def _read(self) -> List[tuple]:
+        return self._connect().execute('SELECT name, presets FROM scenes ORDER BY name').fetchall()
+
+    def _write(self, name: str, presets: str):
+        connection = self._connect()
+        connection.execute('INSERT OR REPLACE INTO scenes (name, presets, updated) VALUES (?, ?, ?)',
+                           (name, presets, time.time()))
+        connection.commit()
+
+    def _delete(self, name: str):
+        connection = self._connect()
+        connection.execute('DELETE FROM scenes WHERE name = ?', (name,))
+        connection.commit()
+
+    async def _run(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    async def load(self):
+        """Reads every scene from the database and compiles it, yielding to
+        the event loop between scenes.
+        """
+        for name, presets in await self._run(self._read):
+            try:
+                self.scenes[name] = Scene(name, json.loads(presets))
+            except (InvalidUsage, ValueError) as e:
+                print('Scenes: Skipping invalid scene ' + name + ': ' + str(e))
+            await asyncio.sleep(0)
+
+        if config.core.debug:
+            print('Scenes: Loaded ' + str(len(self.scenes)) + ' scenes')
+
+    def get(self, name: str) -> Scene:
+        return self.scenes.get(name)
+
+    def __iter__(self):
+        return iter(list(self.scenes.values()))
+
+    async def save(self, name: str, presets: List[Dict]) -> Scene:
+        scene = Scene(name, presets)
+        await self._run(self._write, name, json.dumps(presets))
+        self.scenes[name] = scene
+        return scene
+
+    async def delete(self, name: str):
+        await self._run(self._delete, name)
+        self.scenes.pop(name, None)
+
+    async def activate(self, name: str) -> List[Preset]:
+        new_presets = self.scenes[name].instantiate()
+        await lights.put_presets(new_presets)
+        return new_presets
+
+
+store: SceneStore = SceneStore(config.core.scene_path)
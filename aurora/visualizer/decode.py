@@ -0,0 +1,116 @@
+"""Views chunks of raw PCM audio as samples.
+
+Chunks are interleaved frames of little endian samples in one of the
+SAMPLE_FORMATS. The samples of 16 bit, 32 bit and float formats are read
+through strided NumPy views into the chunk, so selecting a channel copies
+nothing. 24 bit samples have no NumPy type and are unpacked into a buffer
+that is allocated once. Mixing the channels down sums them into a buffer
+too.
+
+Samples are analyzed at the scale of their own format. The scale of each
+format brings them to the range of 16 bit samples, which the silence
+threshold and the preloaded statistics of the visualizer are tuned for.
+"""
+from typing import Union
+
+import numpy as np
+
+from aurora.configuration import Configuration
+
+# Bytes per sample and scale to 16 bit samples of each sample format, by
+# its ALSA name
+SAMPLE_FORMATS = {
+    'S16_LE': (2, 1.0),
+    'S24_LE': (4, 1.0 / 256),  # 24 bits in the low three bytes of four
+    'S24_3LE': (3, 1.0 / 256),
+    'S32_LE': (4, 1.0 / 65536),
+    'FLOAT_LE': (4, 32768.0),
+}
+
+# The audio channel of a filter that mixes every channel down
+MIX = 'mix'
+
+# Chunks whose loudest sample, at the 16 bit scale, is below this are silent
+SILENCE_THRESHOLD = 250
+
+
+class Decoder(object):
+
+    def __init__(self, sample_format: str, channels: int, sample_rate: int, chunk_size: int):
+        """
+        :param sample_format: one of SAMPLE_FORMATS
+        :param channels: number of interleaved channels
+        :param sample_rate: frames per second
+        :param chunk_size: bytes per chunk, a whole number of frames
+        """
+        if sample_format not in SAMPLE_FORMATS:
+            raise ValueError('Unknown sample format: ' + str(sample_format))
+        self.sample_format = sample_format
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.bytes_per_sample, self.scale = SAMPLE_FORMATS[sample_format]
+        self.bytes_per_frame = self.bytes_per_sample * channels
+        if chunk_size % self.bytes_per_frame != 0:
+            raise ValueError('The chunk size must be a multiple of ' + str(self.bytes_per_frame) + ' bytes.')
+        self.frames_per_chunk = chunk_size // self.bytes_per_frame
+
+        self.dtype = {'S16_LE': '<i2', 'S32_LE': '<i4', 'FLOAT_LE': '<f4'}.get(sample_format, '<i4')
+        self.unpacked = np.zeros((self.frames_per_chunk, channels), dtype=np.int32)
+        self.mixed = np.zeros(self.frames_per_chunk, dtype=np.float32)
+
+    @staticmethod
+    def from_config(audio: Configuration.Audio) -> 'Decoder':
+        return Decoder(audio.sample_format, audio.audio_channels, audio.sample_rate, audio.chunk_size)
+
+    def get_chunk_duration(self) -> float:
+        return self.frames_per_chunk / self.sample_rate
+
+    def frames(self, data, count: int = 0) -> np.ndarray:
+        """Returns the samples of a chunk, one row per frame and one column
+        per channel. With `count`, `data` holds that many chunks, which are
+        returned one per leading row.
+
+        Only 24 bit samples are copied. The rows of a single chunk are
+        unpacked into the same buffer every time.
+        """
+        shape = (self.frames_per_chunk, self.channels) if count == 0 \
+            else (count, self.frames_per_chunk, self.channels)
+        if self.bytes_per_sample == 3:
+            packed = np.frombuffer(data, dtype=np.uint8).reshape(shape + (3,))
+            out = self.unpacked if count == 0 else np.empty(shape, dtype=np.int32)
+            # The top byte carries the sign
+            out[...] = packed[..., 2].view(np.int8)
+            out <<= 8
+            out |= packed[..., 1]
+            out <<= 8
+            out |= packed[..., 0]
+            return out
+
+        samples = np.frombuffer(data, dtype=self.dtype).reshape(shape)
+        if self.sample_format == 'S24_LE':
+            # The top byte is padding, sign extend the low three
+            out = self.unpacked if count == 0 else np.empty(shape, dtype=np.int32)
+            np.left_shift(samples, 8, out=out)
+            out >>= 8
+            return out
+        return samples
+
+    def select(self, frames: np.ndarray, source: Union[int, str]) -> np.ndarray:
+        """Returns the samples of one channel of `frames`, or of every channel
+        mixed down when `source` is MIX.
+        """
+        if source != MIX:
+            return frames[..., source]
+        if self.channels == 1:
+            return frames[..., 0]
+
+        out = self.mixed if frames.ndim == 2 else np.empty(frames.shape[:-1], dtype=np.float32)
+        np.sum(frames, axis=-1, dtype=np.float32, out=out)
+        out *= 1.0 / self.channels
+        return out
+
+    def peaks(self, samples: np.ndarray):
+        """Returns the loudest sample of each chunk at the 16 bit scale."""
+        # The negation is done in float so that the lowest integer sample
+        # doesn't overflow
+        return np.maximum(samples.max(axis=-1), -samples.min(axis=-1).astype(np.float64)) * self.scale
@@ -0,0 +1,33 @@
+cdef class Spectrum(object):
+    cdef object window, data, power
+    cdef double scale
+
+    cpdef update(self, data, double scale=*)
+    cpdef object get_data(self)
+    cpdef object get_power(self)
+
+
+cdef class AudioLevelsBackend(object):
+    cdef object audio_levels, piff
+
+    cpdef object compute(self, Spectrum spectrum)
+
+
+cdef class NumpyBackend(object):
+    cdef:
+        int sample_rate, length
+        object frequency_limits, bands
+
+    cdef build_bands(self, int length)
+    cpdef object compute(self, Spectrum spectrum)
+
+
+cdef class FFT(object):
+    cdef:
+        int chunk_size, sample_rate, num_bins, min_frequency, max_frequency
+        object spectrum, custom_channel_mapping, custom_channel_frequencies, frequency_limits, backend, piff
+
+    cpdef object calculate_levels(self, data, double scale=*)
+    cpdef object calculate_levels_batch(self, data, double scale=*)
+    cpdef object calculate_levels_from(self, Spectrum spectrum)
+    cpdef object calculate_channel_frequency(self)
@@ -7,8 +7,13 @@
 
 """FFT methods for computing / analyzing frequency response of audio.
 
-This is simply a wrapper around rpi-audio-level by Colin Guyon.
-https://github.com/colin-guyon/rpi-audio-levels
+The spectrum is computed by one of two backends:
+
+audio_levels -- a wrapper around rpi-audio-level by Colin Guyon, which runs
+                the FFT on the Raspberry Pi GPU.
+                https://github.com/colin-guyon/rpi-audio-levels
+numpy        -- a portable implementation that sums the power spectrum into
+                channels with a single matrix product.
 
 Initial FFT code inspired from the code posted here:
 http://www.raspberrypi.org/phpBB3/viewtopic.php?t=35838&p=454041
@@ -22,15 +27,116 @@ numpy: for array support - http://www.numpy.org/
 rpi-audio-levels - https://bitbucket.org/tom_slick/rpi-audio-levels (modified for lightshowpi)
 """
 
-from rpi_audio_levels import AudioLevels
+import math
+import numpy as np
 from numpy import *
 
+try:
+    from rpi_audio_levels import AudioLevels
+except ImportError:
+    AudioLevels = None
+
+
+class Spectrum(object):
+    """Windowed audio samples and their power spectrum.
+
+    A spectrum can be shared by several FFTs so that each chunk of audio is
+    only windowed and transformed once, however many visualizers read it.
+    The power spectrum is computed the first time it is asked for.
+    """
+
+    def __init__(self):
+        self.window = hanning(0)
+        self.scale = 1.0
+        self.data = None
+        self.power = None
+
+    def update(self, data, scale=1.0):
+        """Replaces the contents of the spectrum
+
+        :param data: audio samples, one chunk per row
+        :type data: numpy.array
+
+        :param scale: factor applied to the samples along with the window
+        :type scale: float
+        """
+        # if you take an FFT of a chunk of audio, the edges will look like
+        # super high frequency cutoffs. Applying a window tapers the edges
+        # of each end of the chunk down to zero.
+        if data.shape[1] != len(self.window) or scale != self.scale:
+            self.window = (hanning(data.shape[1]) * scale).astype(float32)
+            self.scale = scale
+
+        self.data = data * self.window
+        self.power = None
+
+    def get_data(self):
+        return self.data
+
+    def get_power(self):
+        if self.power is None:
+            # Drop the Nyquist bin so there are exactly length / 2 frequencies
+            fourier = np.fft.rfft(self.data, axis=1)[:, :-1]
+            self.power = fourier.real ** 2 + fourier.imag ** 2
+        return self.power
+
+
+class AudioLevelsBackend(object):
+    """Computes channel levels on the Raspberry Pi GPU with rpi-audio-levels."""
+
+    def __init__(self, chunk_size, num_bins, piff):
+        if AudioLevels is None:
+            raise ImportError('The audio_levels FFT backend requires rpi_audio_levels.')
+        self.audio_levels = AudioLevels(math.log(chunk_size / 2, 2), num_bins)
+        self.piff = piff
+
+    def compute(self, spectrum):
+        cache_matrix = array([self.audio_levels.compute(row, self.piff)[0] for row in spectrum.get_data()],
+                             dtype=np.float64)
+        cache_matrix[isinf(cache_matrix)] = 0.0
+        return cache_matrix
+
+
+class NumpyBackend(object):
+    """Computes channel levels from the power spectrum in NumPy.
+
+    The power spectrum of each chunk is summed into channels by multiplying
+    it with a band matrix that has a row of ones over the FFT bins of each
+    channel. The matrix is built for the length of the data the first time it
+    is seen and reused after that.
+    """
+
+    def __init__(self, sample_rate, frequency_limits):
+        self.sample_rate = sample_rate
+        self.frequency_limits = np.array(frequency_limits, dtype=np.float64)
+        self.length = 0
+        self.bands = None
+
+    def build_bands(self, length):
+        num_frequencies = length // 2
+        piff = ((self.frequency_limits * length) / self.sample_rate).astype(int)
+        piff[:, 1] = np.maximum(piff[:, 1], piff[:, 0] + 1)
+        piff = np.clip(piff, 0, num_frequencies)
+
+        self.bands = np.zeros((len(piff), num_frequencies), dtype=np.float64)
+        for channel, (low, high) in enumerate(piff):
+            self.bands[channel, low:high] = 1.0
+        self.length = length
+
+    def compute(self, spectrum):
+        power = spectrum.get_power()
+        if power.shape[1] * 2 != self.length:
+            self.build_bands(power.shape[1] * 2)
+
+        # take the log10 of each channel's summed power to approximate how
+        # human ears perceive sound levels
+        with np.errstate(divide='ignore'):
+            cache_matrix = np.log10(power.dot(self.bands.T))
+        cache_matrix[isinf(cache_matrix)] = 0.0
+        return cache_matrix
 
-cdef class FFT(object):
 
-    cdef:
-        int chunk_size, sample_rate, num_bins, input_channels, min_frequency, max_frequency
-        object window, custom_channel_mapping, custom_channel_frequencies, frequency_limits, audio_levels, piff
+class FFT(object):
 
     def __init__(self,
                  chunk_size,
@@ -40,9 +146,9 @@ cdef class FFT(object):
                  max_frequency,
                  custom_channel_mapping,
                  custom_channel_frequencies,
-                 input_channels=2):
+                 backend='auto'):
         """
-        :param chunk_size: chunk size of audio data
+        :param chunk_size: number of samples in a chunk of audio
         :type chunk_size: int
 
         :param sample_rate: audio file sample rate
@@ -51,9 +157,6 @@ cdef class FFT(object):
         :param num_bins: length of gpio to process
         :type num_bins: int
 
-        :param input_channels: number of audio input channels to process for (default=2)
-        :type input_channels: int
-
         :param min_frequency: lowest frequency for which a channel will be activated
         :type min_frequency: float
 
@@ -67,19 +170,21 @@ cdef class FFT(object):
                                         utilized for each channel
         :type custom_channel_frequencies: list | int
 
+        :param backend: audio_levels, numpy, or auto to use audio_levels when
+                        rpi_audio_levels is installed and numpy otherwise
+        :type backend: str
+
         """
 
         self.chunk_size = chunk_size
         self.sample_rate = sample_rate
         self.num_bins = num_bins
-        self.input_channels = input_channels
-        self.window = hanning(0)
+        self.spectrum = Spectrum()
         self.min_frequency = min_frequency
         self.max_frequency = max_frequency
         self.custom_channel_mapping = custom_channel_mapping
         self.custom_channel_frequencies = custom_channel_frequencies
         self.frequency_limits = self.calculate_channel_frequency()
-        self.audio_levels = AudioLevels(math.log(chunk_size / 2, 2), num_bins)
 
         fl = array(self.frequency_limits)
         self.piff = ((fl * self.chunk_size) / self.sample_rate).astype(int)
@@ -89,45 +194,63 @@ cdef class FFT(object):
                 self.piff[a][1] += 1
         self.piff = self.piff.tolist()
 
-    cpdef object calculate_levels(self, data_frames):
+        if backend == 'auto':
+            backend = 'audio_levels' if AudioLevels is not None else 'numpy'
+        if backend == 'audio_levels':
+            self.backend = AudioLevelsBackend(chunk_size, num_bins, self.piff)
+        elif backend == 'numpy':
+            self.backend = NumpyBackend(sample_rate, self.frequency_limits)
+        else:
+            raise ValueError('Unknown FFT backend: ' + str(backend))
+
+    def calculate_levels(self, data, scale=1.0):
         """Calculate frequency response for each channel defined in frequency_limits
 
-        :param data_frames: decoder.frames(), audio data for fft calculations
-        :type data_frames: decoder.frames
+        :param data: samples of one audio channel, e.g. from Decoder.select()
+        :type data: numpy.array
+
+        :param scale: factor that brings the samples to the 16 bit scale
+        :type scale: float
 
         :return:
         :rtype: numpy.array
         """
-        # create a numpy array, taking just the left channel if stereo
-        data_stereo = frombuffer(data_frames, dtype="int16")
+        # if all zeros in data then there is no need to do the fft
+        if not data.any():
+            return zeros(self.num_bins, dtype=np.float64)
 
-        if self.input_channels == 2:
-            # data has 2 bytes per channel
-            # pull out the even values, just using left channel
-            data = array(data_stereo[::2])
-        elif self.input_channels == 1:
-            data = data_stereo
+        self.spectrum.update(data[newaxis, :], scale)
+        return self.calculate_levels_from(self.spectrum)[0]
 
-        # if you take an FFT of a chunk of audio, the edges will look like
-        # super high frequency cutoffs. Applying a window tapers the edges
-        # of each end of the chunk down to zero.
-        if len(data) != len(self.window):
-            self.window = hanning(len(data)).astype(float32)
+    def calculate_levels_batch(self, data, scale=1.0):
+        """Calculate frequency response for several chunks at once
 
-        data = data * self.window
+        :param data: samples of one audio channel, one chunk per row
+        :type data: numpy.array
 
-        # if all zeros in data then there is no need to do the fft
-        if all(data == 0.0):
-            return zeros(self.num_bins, dtype=np.float32)
+        :param scale: factor that brings the samples to the 16 bit scale
+        :type scale: float
+
+        :return: one row of channel levels per chunk
+        :rtype: numpy.array
+        """
+        self.spectrum.update(data, scale)
+        return self.calculate_levels_from(self.spectrum)
+
+    def calculate_levels_from(self, spectrum):
+        """Calculate frequency response from a spectrum shared with other FFTs
 
+        :param spectrum: windowed audio, one chunk per row
+        :type spectrum: Spectrum
+
+        :return: one row of channel levels per chunk
+        :rtype: numpy.array
+        """
         # Apply FFT - real data
         # Calculate the power spectrum
-        cache_matrix = array(self.audio_levels.compute(data, self.piff)[0])
-        cache_matrix[isinf(cache_matrix)] = 0.0
-
-        return cache_matrix
+        return self.backend.compute(spectrum)
 
-    cpdef object calculate_channel_frequency(self):
+    def calculate_channel_frequency(self):
         """Calculate frequency values
 
         Calculate frequency values for each channel,
@@ -0,0 +1,23 @@
+cimport cython
+
+cdef extern from "math.h":
+    cpdef double sqrt(double x)
+
+cdef class Stats(object):
+
+    cdef:
+        int length, sample_count
+        double alpha
+        double[:] mean_view, m2_view, variance_view, std_view
+        object mean_array, m2_array, variance_array, std_array
+
+    cdef clear(self)
+    cpdef preload(self, mean, std, sample_count=*)
+    @cython.locals(i=Py_ssize_t, delta=double, increment=double)
+    cpdef push(self, const double[:] data)
+    cdef num_data_values(self)
+    cpdef mean(self)
+    @cython.locals(i=Py_ssize_t, divisor=double)
+    cpdef variance(self)
+    @cython.locals(i=Py_ssize_t)
+    cpdef std(self)
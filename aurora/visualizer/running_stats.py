@@ -0,0 +1,155 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+# Author: Tom Enos
+#
+
+"""Compute a running mean and standard deviation
+
+Receives an numpy array of fft data from visualizer and computes a
+running mean and standard deviation for each element in the array
+
+derived from the work of John D. Cook
+http://www.johndcook.com/blog/standard_deviation/
+
+The statistics are updated in place, so pushing a sample allocates nothing.
+With a window the statistics are exponentially weighted and older samples
+fade out, which lets them follow the music from one song to the next.
+"""
+import cython
+import numpy as np
+
+# Compiled, sqrt is the C function declared in running_stats.pxd
+if not cython.compiled:
+    from math import sqrt
+
+
+class Stats(object):
+
+    def __init__(self, length, window=0):
+        """Constructor
+
+        :param length: the length of the matrix
+        :param window: number of samples that make up most of the weight of
+            the exponentially weighted statistics, 0 to weigh all samples equally
+        """
+        self.length = length
+        self.alpha = 1.0 / window if window > 1 else 0.0
+        self.mean_array = np.zeros(length, dtype=np.float64)
+        self.m2_array = np.zeros(length, dtype=np.float64)
+        self.variance_array = np.zeros(length, dtype=np.float64)
+        self.std_array = np.zeros(length, dtype=np.float64)
+        self.mean_view = self.mean_array
+        self.m2_view = self.m2_array
+        self.variance_view = self.variance_array
+        self.std_view = self.std_array
+        self.clear()
+
+    def clear(self):
+        self.sample_count = 0
+        self.mean_view[:] = 0.0
+        self.m2_view[:] = 0.0
+
+    def preload(self, mean, std, sample_count=2):
+        """Add a starting samples to the running standard deviation and mean
+        
+        This data does not need to be accurate.  It is only a base starting
+        point for our light show.  With out preloading some values the show 
+        will start with all lights on and then slowly change to what we want
+        to see.  
+        
+        :param mean: new sample mean starting point
+        :type mean: numpy array
+        :param std: new sample standard deviation starting point
+        :type std: numpy array
+        :param sample_count: how many samples to start with (min 2)
+        :type sample_count: int
+        """
+        if len(mean) == self.length and len(
+                std) == self.length and sample_count > 1 and self.sample_count == 0:
+            # cast all arrays to numpy just to make sure the data type is correct
+            self.mean_array[:] = np.asarray(mean, dtype=np.float64)
+            self.m2_array[:] = np.asarray(std, dtype=np.float64)
+            self.sample_count = sample_count
+            if self.alpha > 0:
+                # the exponential statistics keep the variance itself
+                self.m2_array /= sample_count - 1.0
+
+    def push(self, data):
+        """Add a new sample to the running standard deviation and mean
+
+        data should be numpy array the same length as self.length
+        :param data: new sample data, this must be a float64 array
+        :type data: numpy array
+        """
+        if data.shape[0] != self.length:
+            raise ValueError('data must have one value per channel.')
+
+        self.sample_count += 1
+
+        if self.sample_count == 1:
+            for i in range(self.length):
+                self.mean_view[i] = data[i]
+                self.m2_view[i] = 0.0
+        elif self.alpha > 0:
+            for i in range(self.length):
+                delta = data[i] - self.mean_view[i]
+                increment = self.alpha * delta
+                self.mean_view[i] += increment
+                self.m2_view[i] = (1.0 - self.alpha) * (self.m2_view[i] + delta * increment)
+        else:
+            for i in range(self.length):
+                delta = data[i] - self.mean_view[i]
+                self.mean_view[i] += delta / self.sample_count
+                self.m2_view[i] += delta * (data[i] - self.mean_view[i])
+
+    def num_data_values(self):
+        """Get the current number of observations in the sample
+        
+        :return: current samples observed
+        :rtype: int
+        """
+        return self.sample_count
+
+    def mean(self):
+        """Get the current mean
+
+        The returned array is updated in place by every push.
+
+        :return: current sampled mean
+        :rtype: numpy array
+        """
+        return self.mean_array
+
+    def variance(self):
+        """Get the current variance 
+
+        The returned array is updated in place by every call.
+
+        :return: current variance
+        :rtype: numpy array
+        """
+        divisor = 1.0
+        if self.sample_count <= 1:
+            self.variance_view[:] = 0.0
+            return self.variance_array
+
+        if self.alpha == 0:
+            divisor = self.sample_count - 1.0
+        for i in range(self.length):
+            self.variance_view[i] = self.m2_view[i] / divisor
+        return self.variance_array
+
+    def std(self):
+        """Get the current standard deviation 
+
+        The returned array is updated in place by every call.
+
+        :return: current standard deviation
+        :rtype: numpy array
+        """
+        self.variance()
+        for i in range(self.length):
+            self.std_view[i] = sqrt(self.variance_view[i])
+        return self.std_array
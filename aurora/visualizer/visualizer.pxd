@@ -0,0 +1,40 @@
+cimport cython
+from aurora.visualizer.running_stats cimport Stats
+
+cdef int DELAY_CAPACITY
+
+cdef extern from "math.h":
+    cpdef double rint(double x)
+
+cdef class Visualizer(object):
+
+    cdef:
+        int num_channels, light_delay, ring_pos, ring_count
+        double sd_low, sd_high, attenuation, decay_factor
+        public object pins, source
+        object filter, channels, output, decoder, fft_calc, mean, std, ring_array, levels_array, input_array
+        Stats running_stats
+        double[:, :] ring
+        double[:] decay, mean_view, std_view, levels, input_view
+
+    cpdef visualize(self, data)
+    cpdef push_silence(self)
+    cpdef push_levels(self, matrix)
+    @cython.locals(rows='const double[:, :]', i=Py_ssize_t)
+    cpdef catch_up_levels(self, matrices, loud)
+    cpdef object get_fft(self)
+    cpdef set_light_delay(self, int chunks)
+    cdef advance(self)
+    @cython.locals(matrix='const double[:]', mean='const double[:]', std='const double[:]',
+                   i=Py_ssize_t, brightness=double)
+    cdef update_lights(self, int row)
+
+
+cdef class VisualizerHub(object):
+    cdef object visualizers, decoder, spectra
+    cdef int light_delay
+
+    cdef object get_spectrum(self, source)
+    cdef bint analyze(self, frames, source)
+    cpdef visualize(self, data)
+    cpdef catch_up(self, data, int count)
@@ -0,0 +1,252 @@
+from time import perf_counter
+from typing import List
+import cython
+import numpy as np
+from aurora import hardware, metrics
+from aurora.configuration import Channel, Configuration, get_config
+from aurora.visualizer.decode import SILENCE_THRESHOLD, Decoder
+from aurora.visualizer.fft import FFT, Spectrum
+from aurora.visualizer.running_stats import Stats
+
+# Compiled, rint is the C function declared in visualizer.pxd
+if not cython.compiled:
+    from numpy import rint
+
+# Number of analyzed chunks the delay line can hold
+DELAY_CAPACITY = 1000
+
+
+class Visualizer(object):
+
+    def __init__(self, channels: List[Channel], vfilter: Configuration.Filter, output=hardware,
+                 decoder: Decoder = None):
+        super().__init__()
+        self.filter = vfilter
+        self.output = output
+        self.decoder = Decoder.from_config(get_config().audio) if decoder is None else decoder
+        # The audio channel that is analyzed, or decode.MIX for all of them
+        self.source = self.filter.audio_channel
+        self.channels = channels
+        self.num_channels = len(self.channels)
+        self.pins = np.array([c.pin for c in self.channels], dtype=np.intc)
+        self.decay = np.zeros(self.num_channels, dtype=np.float64)
+        if self.filter.custom_channel_frequencies != 0:
+            if self.filter.custom_channel_frequencies != self.num_channels + 1:
+                self.filter.custom_channel_frequencies = 0
+        self.fft_calc = FFT(self.decoder.frames_per_chunk,
+                            self.decoder.sample_rate,
+                            self.num_channels,
+                            self.filter.min_frequency,
+                            self.filter.max_frequency,
+                            self.filter.custom_channel_mapping,
+                            self.filter.custom_channel_frequencies,
+                            self.filter.fft_backend)
+
+        self.sd_low = self.filter.sd_low
+        self.sd_high = self.filter.sd_high
+        self.attenuation = 1.0 - (self.filter.attenuate_pct / 100.0)
+        self.decay_factor = self.filter.decay_factor
+
+        self.set_light_delay(int(self.filter.delay / self.decoder.get_chunk_duration()))
+
+        # The delay line is a ring of analyzed chunks, newest at ring_pos - 1
+        self.ring_array = np.zeros((DELAY_CAPACITY, self.num_channels), dtype=np.float64)
+        self.ring = self.ring_array
+        self.ring_pos = 0
+        self.ring_count = 0
+        self.levels_array = np.zeros(self.num_channels, dtype=np.float64)
+        self.levels = self.levels_array
+        # The levels of the chunk being pushed. Reading the caller's array
+        # through a typed memoryview would wrap it in a new object each time.
+        self.input_array = np.zeros(self.num_channels, dtype=np.float64)
+        self.input_view = self.input_array
+
+        self.mean = np.array([12.0 for _ in range(self.num_channels)], dtype=np.float64)
+        self.std = np.array([1.5 for _ in range(self.num_channels)], dtype=np.float64)
+
+        self.running_stats = Stats(self.num_channels, self.filter.stats_window)
+        self.running_stats.preload(self.mean, self.std, self.num_channels)
+        # Both arrays are updated in place by the running stats
+        self.mean = self.running_stats.mean()
+        self.std = self.running_stats.std()
+        self.mean_view = self.mean
+        self.std_view = self.std
+
+    def visualize(self, data):
+        """Analyzes and displays a single chunk of audio on its own. Use a
+        VisualizerHub to share the analysis between several visualizers.
+        """
+        if len(data):
+            samples = self.decoder.select(self.decoder.frames(data), self.source)
+            # if the maximum of the absolute value of all samples in
+            # data is below a threshold we will disregard it
+            if self.decoder.peaks(samples) < SILENCE_THRESHOLD:
+                self.push_silence()
+            else:
+                self.push_levels(self.fft_calc.calculate_levels(samples, self.decoder.scale))
+
+    def push_silence(self):
+        # we will fill the matrix with zeros and turn the lights off
+        self.ring[self.ring_pos, :] = 0.0
+        self.advance()
+
+    def push_levels(self, matrix):
+        np.copyto(self.input_array, matrix)
+        self.running_stats.push(self.input_view)
+        self.running_stats.std()
+        self.ring[self.ring_pos, :] = self.input_view
+        self.advance()
+
+    def catch_up_levels(self, matrices, loud):
+        """Pushes the levels of stale chunks through the running stats and
+        the delay line without updating the lights. Rows of `matrices` where
+        `loud` is False are silent.
+        """
+        rows = matrices
+        for i in range(rows.shape[0]):
+            if loud[i]:
+                self.running_stats.push(rows[i])
+            self.ring[self.ring_pos, :] = rows[i]
+            self.ring_pos = (self.ring_pos + 1) % DELAY_CAPACITY
+            self.ring_count = min(self.ring_count + 1, DELAY_CAPACITY)
+        self.running_stats.std()
+
+    def get_fft(self):
+        return self.fft_calc
+
+    def set_light_delay(self, chunks):
+        """Shows each chunk `chunks` chunks after it was analyzed instead
+        of after the filter's delay.
+        """
+        self.light_delay = max(0, min(chunks, DELAY_CAPACITY - 1))
+
+    def advance(self):
+        """Moves past the newest row of the delay line and shows the row
+        that is light_delay chunks old.
+        """
+        self.ring_pos = (self.ring_pos + 1) % DELAY_CAPACITY
+        self.ring_count = min(self.ring_count + 1, DELAY_CAPACITY)
+
+        if self.ring_count > self.light_delay:
+            self.update_lights((self.ring_pos - 1 - self.light_delay) % DELAY_CAPACITY)
+
+    def update_lights(self, row):
+        matrix = self.ring[row]
+        mean = self.mean_view
+        std = self.std_view
+
+        for i in range(self.num_channels):
+            brightness = matrix[i] - mean[i] + (std[i] * self.sd_low)
+            brightness = (brightness / (std[i] * (self.sd_low + self.sd_high))) * self.attenuation
+
+            # insure that the brightness levels are in the correct range
+            brightness = min(max(brightness, 0.0), 1.0)
+            brightness = rint(brightness * 1000.0) / 1000.0
+
+            # calculate light decay rate if used
+            if self.decay_factor > 0:
+                if self.decay[i] <= brightness:
+                    self.decay[i] = brightness
+                if self.decay[i] - self.decay_factor > 0:
+                    brightness = self.decay[i] - self.decay_factor
+                    self.decay[i] = brightness
+
+            self.levels[i] = brightness * 100
+
+        self.output.set_levels(self.pins, self.levels_array)
+
+
+class VisualizerHub(object):
+    """Analyzes each chunk of audio once for any number of visualizers.
+
+    Every chunk is windowed and transformed a single time for each audio
+    channel, or mixdown, that a visualizer reads. Each visualizer then maps
+    the shared spectrum onto its own channels with its own filter, running
+    stats and delay line.
+    """
+
+    def __init__(self, decoder: Decoder = None):
+        self.visualizers = {}
+        self.decoder = Decoder.from_config(get_config().audio) if decoder is None else decoder
+        # Spectrum of each audio channel read by a visualizer
+        self.spectra = {}
+        self.light_delay = -1
+
+    def add(self, key, visualizer):
+        if self.light_delay >= 0:
+            visualizer.set_light_delay(self.light_delay)
+        self.visualizers[key] = visualizer
+
+    def set_light_delay(self, chunks):
+        """Overrides the delay of every visualizer, including ones added
+        later, e.g. with the latency of the playback device.
+        """
+        if chunks == self.light_delay:
+            return
+        self.light_delay = chunks
+        for visualizer in self.visualizers.values():
+            visualizer.set_light_delay(chunks)
+
+    def remove(self, key):
+        self.visualizers.pop(key, None)
+
+    def __len__(self):
+        return len(self.visualizers)
+
+    def get_spectrum(self, source):
+        spectrum = self.spectra.get(source)
+        if spectrum is None:
+            spectrum = Spectrum()
+            self.spectra[source] = spectrum
+        return spectrum
+
+    def analyze(self, frames, source):
+        """Windows the samples of `source` in a chunk of frames into its
+        spectrum. Returns False without doing so when they are silent.
+        """
+        samples = self.decoder.select(frames, source)
+        # if the maximum of the absolute value of all samples in
+        # data is below a threshold we will disregard it
+        if self.decoder.peaks(samples) < SILENCE_THRESHOLD:
+            return False
+
+        start = perf_counter()
+        self.get_spectrum(source).update(samples[np.newaxis, :], self.decoder.scale)
+        metrics.fft_seconds.observe(perf_counter() - start)
+        return True
+
+    def visualize(self, data):
+        if len(data) == 0 or len(self.visualizers) == 0:
+            return
+
+        frames = self.decoder.frames(data)
+        loud = {}
+        for visualizer in self.visualizers.values():
+            source = visualizer.source
+            if source not in loud:
+                loud[source] = self.analyze(frames, source)
+            if loud[source]:
+                visualizer.push_levels(visualizer.get_fft().calculate_levels_from(self.spectra[source])[0])
+            else:
+                visualizer.push_silence()
+
+    def catch_up(self, data, count):
+        """Pushes `count` stale chunks through every visualizer without
+        updating the lights. All chunks of an audio channel are transformed
+        in one batched FFT.
+        """
+        frames = self.decoder.frames(data, count)
+        analyzed = {}
+        for visualizer in self.visualizers.values():
+            source = visualizer.source
+            if source not in analyzed:
+                samples = self.decoder.select(frames, source)
+                analyzed[source] = self.decoder.peaks(samples) >= SILENCE_THRESHOLD
+                if analyzed[source].any():
+                    self.get_spectrum(source).update(samples[analyzed[source]], self.decoder.scale)
+
+            loud = analyzed[source]
+            matrices = np.zeros((count, len(visualizer.pins)), dtype=np.float64)
+            if loud.any():
+                matrices[loud] = visualizer.get_fft().calculate_levels_from(self.spectra[source])
+            visualizer.catch_up_levels(matrices, loud)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3.7
+"""Measures how long the server takes to start.
+
+The server is started with `python3.7 -m aurora` and polled until it answers
+`GET /api/v2/` (first served request). Nothing that was shown before the
+restart is restored, so a levels preset is then posted and
+`GET /api/v2/metrics` is polled until the hardware module has written a
+level to the output backend (lights on). Both are measured from the start of
+the process. Every run starts a fresh process, the medians of all runs are
+reported.
+
+The server reads its configuration as usual, so run this on the Pi with the
+service stopped. Build the extensions first, otherwise the plain Python
+fallback is measured.
+
+Usage: python3.7 benchmarks/startup.py [runs]
+"""
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from aurora.configuration import Configuration
+
+# Seconds to wait for the server before giving up on a run
+timeout = 60.0
+
+
+def request(url: str, body=None):
+    data = None if body is None else json.dumps(body).encode()
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=1.0) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return None
+
+
+def levels_written(base: str) -> int:
+    """Returns the number of levels the server has written to its output."""
+    with urllib.request.urlopen(base + '/metrics', timeout=1.0) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith('aurora_hardware_writes_total '):
+                return int(line.split()[1])
+    raise RuntimeError('The server does not report aurora_hardware_writes_total')
+
+
+def measure(base: str, preset: dict):
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'aurora'],
+                              cwd=os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while request(base + '/') != 200:
+            if server.poll() is not None:
+                raise RuntimeError('The server exited with status ' + str(server.returncode))
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError('The server did not answer within ' + str(timeout) + ' seconds')
+            time.sleep(0.01)
+        first_request = time.perf_counter() - start
+
+        # The pins are enabled at 0, any level written is the preset's
+        written = levels_written(base)
+        status = request(base + '/presets', preset)
+        if status != 201:
+            raise RuntimeError('Posting the preset failed with status ' + str(status))
+        while levels_written(base) == written:
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError('The preset was not shown within ' + str(timeout) + ' seconds')
+            time.sleep(0.001)
+        lights_on = time.perf_counter() - start
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+    return first_request, lights_on
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    config = Configuration()
+    hostname = '127.0.0.1' if config.core.hostname in ('0.0.0.0', '') else config.core.hostname
+    base = 'http://{}:{}/api/v2'.format(hostname, config.core.port)
+    labels = {c.label: 100 for c in config.hardware.channels if c.device == config.hardware.devices[0]}
+    preset = {
+        'name': 'startup-benchmark',
+        'devices': [config.hardware.devices[0]],
+        'payload': {'type': 'levels', 'levels': labels},
+    }
+
+    first_requests = []
+    lights_on = []
+    for i in range(runs):
+        first_request, on = measure(base, preset)
+        first_requests.append(first_request)
+        lights_on.append(on)
+        print('run {:<3} first request {:7.3f} s  lights on {:7.3f} s'.format(i + 1, first_request, on))
+
+    print('median  first request {:7.3f} s  lights on {:7.3f} s'.format(
+        statistics.median(first_requests), statistics.median(lights_on)))
+
+
+if __name__ == '__main__':
+    main()
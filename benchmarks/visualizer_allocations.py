@@ -0,0 +1,105 @@
+#!/usr/bin/env python3.7
+"""Measures heap allocations on the visualizer's per-chunk path.
+
+Analyzed levels are pushed through the running stats, the delay line and the
+brightness calculation of a Visualizer whose output discards the levels. The
+FFT itself is not part of the measured path. After a warm up tracemalloc is
+started and the highest memory it traced while the chunks were pushed must
+be zero, i.e. not a single chunk allocated anything, not even temporaries
+that are freed again.
+
+The guarantee only holds for the compiled extension, build it first with
+`python3.7 setup.py build_ext --inplace`. Plain Python boxes every float it
+computes, so without the build the numbers are printed but not checked.
+
+Usage: python3.7 benchmarks/visualizer_allocations.py [chunks]
+"""
+import itertools
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import numpy as np
+
+from aurora.configuration import Configuration, get_config
+
+# The hardware module, imported by the visualizer, creates its backend when
+# it is imported. The levels only ever go to a NullOutput.
+get_config().hardware.output = 'recording'
+
+from aurora.visualizer import visualizer as visualizer_module
+from aurora.visualizer.visualizer import Visualizer
+
+
+class NullOutput(object):
+    def set_levels(self, pins, levels):
+        pass
+
+
+def prepare_chunks(visualizer, matrices):
+    """Returns an endless iterator of (method, arguments) calls. They are
+    built up front so that the loop that makes them allocates nothing itself.
+    """
+    calls = []
+    for i in range(len(matrices) * 10):
+        # Every tenth chunk is silent, like the gaps between songs
+        if i % 10 == 0:
+            calls.append((visualizer.push_silence, ()))
+        else:
+            calls.append((visualizer.push_levels, (matrices[i % len(matrices)],)))
+    return itertools.cycle(calls)
+
+
+def push_chunks(calls):
+    for method, arguments in calls:
+        method(*arguments)
+
+
+def measure(visualizer, matrices, chunks):
+    source = prepare_chunks(visualizer, matrices)
+    # Warm up, fills the delay line and any lazily created caches. The first
+    # pass also fills the cycle's copy of the calls.
+    push_chunks(itertools.islice(source, 2000))
+    calls = itertools.islice(source, chunks)
+
+    start = time.perf_counter()
+    tracemalloc.start()
+    push_chunks(calls)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak, time.perf_counter() - start
+
+
+def main():
+    chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    config = Configuration()
+    compiled = not visualizer_module.__file__.endswith('.py')
+    print('visualizer: ' + ('compiled' if compiled else 'plain Python'))
+    failed = False
+
+    for window in (0, 200):
+        vfilter = Configuration.Filter({'name': 'benchmark', 'decay_factor': 0.02,
+                                        'stats_window': window, 'fft_backend': 'numpy'})
+        visualizer = Visualizer(config.hardware.channels, vfilter, NullOutput())
+        levels = np.random.RandomState(0).uniform(8, 16, (64, len(config.hardware.channels)))
+        matrices = [levels[i] for i in range(levels.shape[0])]
+
+        current, peak, elapsed = measure(visualizer, matrices, chunks)
+        print('stats_window={:<4} {:>8} chunks  {:6.2f} us/chunk  '
+              'retained {} B  peak {} B'.format(window, chunks, elapsed / chunks * 1e6, current, peak))
+        failed = failed or peak > 0
+
+    if not compiled:
+        print('NOT CHECKED: only the compiled visualizer is free of allocations')
+    elif failed:
+        print('FAIL: the per-chunk path allocates memory')
+        sys.exit(1)
+    else:
+        print('OK: no allocations per chunk')
+
+
+if __name__ == '__main__':
+    main()
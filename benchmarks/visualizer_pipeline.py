@@ -0,0 +1,490 @@
+#!/usr/bin/env python3.7
+"""Measures the visualizer's audio path from end to end.
+
+Synthetic audio (a sine sweep, pink noise, a drum loop and silence) is
+written into a real named pipe by a separate process and read by
+protocols.read_fifo as in the server. A visualizer shows it on a recording
+output backend in place of the lights, with the filter's delay set to 0.
+Each signal is played twice: once at the speed it would be played, which
+gives the latency from writing a chunk into the pipe until its levels are
+written to the output, and once as fast as the pipe allows, which gives the
+number of chunks per second the pipeline keeps up with.
+
+The same audio is then pushed through each stage on its own to measure the
+CPU time and the memory allocated per chunk:
+
+    ingest  -- the FIFO protocol's ring buffer, without visualizers
+    fft     -- decoding, mixdown, windowing, FFT and the levels of each channel
+    stats   -- running stats, delay line and brightness
+    output  -- hardware.set_levels, with a backend that discards the levels
+
+With --save the results become the baseline of this machine, stored in
+visualizer_pipeline.json next to this script. With --check the script fails
+when a result is worse than its baseline by more than the tolerance. The
+memory each stage allocates is checked too.
+
+Baselines are kept per CPU architecture, audio format and build, compiled or
+plain Python, because the numbers differ by far more than the tolerance
+between them. The committed file holds a reference baseline of an x86_64
+machine. Before checking on any other machine, e.g. a Pi, build the
+extensions and save its baseline on it from a commit that is known to be
+good:
+
+    python3.7 setup.py build_ext --inplace
+    python3.7 benchmarks/visualizer_pipeline.py --save
+
+and commit visualizer_pipeline.json along with it. --check fails when the
+file has no baseline for the machine it runs on.
+
+Every signal is benchmarked --repeat times and the best of each result is
+kept.
+
+Chunks hold the same number of frames in every sample format, as many as
+a chunk of chunkSize bytes of 16 bit audio.
+
+Usage: python3.7 benchmarks/visualizer_pipeline.py [--seconds 5] [--rate 44100]
+           [--channels 2] [--format S16_LE] [--signals sweep,pink,drums,silence]
+           [--repeat 3] [--save | --check]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import numpy as np
+import uvloop
+
+from aurora.configuration import Configuration, get_config
+
+config = get_config()
+# The server reads audio from the pipe directly and drives the lights
+config.audio.play_audio = False
+config.audio.visualizer_process = False
+# The hardware module creates its backend when it is imported, which must
+# not touch the pins. main() swaps in a recording backend with a limit.
+config.hardware.output = 'recording'
+
+from aurora import hardware, outputs, protocols
+
+protocols.debug = False
+from aurora.visualizer.decode import MIX, SAMPLE_FORMATS, SILENCE_THRESHOLD, Decoder
+from aurora.visualizer.fft import Spectrum
+from aurora.visualizer import visualizer as visualizer_module
+from aurora.visualizer.visualizer import Visualizer, VisualizerHub
+
+baseline_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'visualizer_pipeline.json')
+
+# Results where a larger value is better, every other result is a time
+higher_is_better = {'chunks_per_second'}
+
+# Differences smaller than these never count as a regression, by unit
+min_difference = {'us': 2.0, 'ms': 0.1, 'pct': 1.0, 'second': 0.0, 'bytes': 256}
+
+signals = ['sweep', 'pink', 'drums', 'silence']
+
+
+# --------------------------------------------------------------- #
+# Synthetic audio
+# --------------------------------------------------------------- #
+
+def generate(name: str, seconds: float, rate: int, channels: int, sample_format: str) -> bytes:
+    """Returns `seconds` of interleaved audio in the given sample format."""
+    frames = int(seconds * rate)
+    t = np.arange(frames) / rate
+    random = np.random.RandomState(0)
+
+    if name == 'sweep':
+        # Exponential sweep from 20 Hz to 16 kHz, repeated every 2 seconds
+        period = 2.0
+        k = np.log(16000 / 20) / period
+        phase = 2 * np.pi * 20 * (np.exp(k * (t % period)) - 1) / k
+        mono = 0.5 * np.sin(phase)
+    elif name == 'pink':
+        # White noise shaped to 1/f power
+        spectrum = np.fft.rfft(random.normal(size=frames))
+        frequencies = np.fft.rfftfreq(frames, 1 / rate)
+        frequencies[0] = frequencies[1]
+        mono = np.fft.irfft(spectrum / np.sqrt(frequencies), frames)
+        mono *= 0.3 / np.abs(mono).max()
+    elif name == 'drums':
+        # 120 bpm: a kick on every beat, a snare on 2 and 4, hats on eighths
+        mono = np.zeros(frames)
+        beat = int(rate * 0.5)
+        decay = np.arange(beat) / rate
+        kick = np.sin(2 * np.pi * (50 + 100 * np.exp(-decay * 30)) * decay) * np.exp(-decay * 8)
+        snare = random.normal(size=beat) * np.exp(-decay * 20) * 0.5
+        hat = np.diff(random.normal(size=beat + 1)) * np.exp(-decay * 80) * 0.2
+        for start in range(0, frames, beat):
+            length = min(beat, frames - start)
+            mono[start:start + length] += kick[:length]
+            if (start // beat) % 2 == 1:
+                mono[start:start + length] += snare[:length]
+            for offset in (0, beat // 2):
+                if start + offset < frames:
+                    length = min(beat, frames - start - offset)
+                    mono[start + offset:start + offset + length] += hat[:length]
+        mono *= 0.7 / np.abs(mono).max()
+    elif name == 'silence':
+        mono = np.zeros(frames)
+    else:
+        raise ValueError('Unknown signal: ' + name)
+
+    # Every channel gets the same audio at a slightly different volume
+    gains = np.linspace(1.0, 0.8, channels)
+    samples = mono[:, np.newaxis] * gains[np.newaxis, :]
+    if sample_format == 'S16_LE':
+        return (samples * 32767).astype('<i2').tobytes()
+    if sample_format == 'S32_LE':
+        return (samples * 2147483647).astype('<i4').tobytes()
+    if sample_format == 'FLOAT_LE':
+        return samples.astype('<f4').tobytes()
+    samples = (samples * 8388607).astype('<i4')
+    if sample_format == 'S24_3LE':
+        return samples.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return samples.tobytes()
+
+
+def configure(rate: int, channels: int, sample_format: str):
+    """Sets the format of the audio source, keeping the frames per chunk."""
+    frames_per_chunk = config.audio.chunk_size // (2 * config.audio.audio_channels)
+    config.audio.sample_rate = rate
+    config.audio.audio_channels = channels
+    config.audio.sample_format = sample_format
+    config.audio.chunk_size = frames_per_chunk * channels * SAMPLE_FORMATS[sample_format][0]
+    protocols.chunk_size = config.audio.chunk_size
+    protocols.decoder = Decoder.from_config(config.audio)
+
+
+def write_audio(path: str, audio: bytes, chunk_size: int, chunk_duration: float, written):
+    """Writes `audio` into the pipe one chunk at a time, every chunk_duration
+    seconds or as fast as possible when it is 0. The time each chunk was
+    written is stored in `written`.
+    """
+    fd = os.open(path, os.O_WRONLY)
+    start = time.monotonic()
+    for i in range(len(audio) // chunk_size):
+        if chunk_duration > 0:
+            delay = start + i * chunk_duration - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        os.write(fd, audio[i * chunk_size:(i + 1) * chunk_size])
+        written[i] = time.monotonic()
+    os.close(fd)
+
+
+# --------------------------------------------------------------- #
+# End to end
+# --------------------------------------------------------------- #
+
+class ProbeHub(VisualizerHub):
+    """A visualizer hub that times every chunk it is given."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunk = 0
+        self.durations = []
+
+    def visualize(self, data):
+        start = time.perf_counter()
+        super().visualize(data)
+        self.durations.append(time.perf_counter() - start)
+        self.chunk += 1
+
+    def catch_up(self, data, count):
+        super().catch_up(data, count)
+        self.chunk += count
+
+
+class ProbeOutput(object):
+    """Passes the levels of a visualizer on to the hardware, noting when the
+    levels of each chunk were written.
+    """
+
+    def __init__(self, hub: ProbeHub):
+        self.hub = hub
+        self.shown = {}
+
+    def set_levels(self, pins, levels):
+        hardware.set_levels(pins, levels)
+        self.shown[self.hub.chunk] = time.monotonic()
+
+
+def create_filter(name: str) -> Configuration.Filter:
+    vfilter = Configuration.Filter(dict(vars(config.get_filter(name))))
+    vfilter.delay = 0.0
+    return vfilter
+
+
+def unblock(path: str):
+    """Lets a reader that is still waiting for a writer open the pipe."""
+    try:
+        os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+
+async def play(audio: bytes, vfilter: Configuration.Filter, chunk_duration: float):
+    path = os.path.join(tempfile.mkdtemp(prefix='aurora-benchmark-'), 'fifo')
+    config.audio.fifo_path = path
+    chunk_size = protocols.chunk_size
+    chunks = len(audio) // chunk_size
+    hub = ProbeHub()
+    output = ProbeOutput(hub)
+    hub.add(0, Visualizer(config.hardware.channels, vfilter, output))
+    protocols.AudioFifoProtocol.visualizer_hub = hub
+
+    written = multiprocessing.RawArray('d', chunks)
+    writer = multiprocessing.Process(target=write_audio, args=(path, audio, chunk_size, chunk_duration, written))
+    reader = asyncio.get_event_loop().create_task(protocols.read_fifo())
+
+    # read_fifo creates the pipe
+    while not os.path.exists(path):
+        await asyncio.sleep(0.001)
+
+    cpu = time.process_time()
+    start = time.monotonic()
+    writer.start()
+    while hub.chunk < chunks and (writer.is_alive() or time.monotonic() - start < 2.0):
+        await asyncio.sleep(0.01)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+
+    writer.join()
+    reader.cancel()
+    unblock(path)
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+    protocols.AudioFifoProtocol.visualizer_hub = None
+
+    latencies = [output.shown[i] - written[i] for i in range(chunks) if i in output.shown]
+    return {
+        'chunks': hub.chunk,
+        'shown': len(latencies),
+        'elapsed': elapsed,
+        'cpu': cpu,
+        'durations': hub.durations,
+        'latencies': latencies,
+    }
+
+
+# --------------------------------------------------------------- #
+# Stages
+# --------------------------------------------------------------- #
+
+class NullOutput(object):
+    def set_levels(self, pins, levels):
+        pass
+
+
+class NullBackend(outputs.OutputBackend):
+    def write(self, pin, level):
+        pass
+
+
+def run_stages(audio: bytes, vfilter: Configuration.Filter):
+    """Returns a function per stage that pushes every chunk of `audio`
+    through that stage alone.
+    """
+    chunk_size = protocols.chunk_size
+    chunks = [audio[i:i + chunk_size] for i in range(0, len(audio) - chunk_size + 1, chunk_size)]
+    decoder = protocols.decoder
+    # The hub only analyzes chunks that aren't silent
+    loud = [decoder.peaks(decoder.select(decoder.frames(chunk), MIX)) >= SILENCE_THRESHOLD for chunk in chunks]
+    visualizer = Visualizer(config.hardware.channels, vfilter, NullOutput())
+    fft = visualizer.get_fft()
+    spectrum = Spectrum()
+    matrices = []
+    for chunk, is_loud in zip(chunks, loud):
+        spectrum.update(decoder.select(decoder.frames(chunk), MIX)[np.newaxis, :], decoder.scale)
+        matrices.append(fft.calculate_levels_from(spectrum)[0] if is_loud else None)
+    pins = np.array([c.pin for c in config.hardware.channels], dtype=np.intc)
+    levels = [np.array([(i * 7 + j) % 101 for j in range(len(pins))], dtype=np.float64) for i in range(len(chunks))]
+
+    protocol = protocols.AudioFifoProtocol()
+
+    def ingest():
+        for chunk in chunks:
+            buffer = protocol.get_buffer(-1)
+            buffer[:chunk_size] = chunk
+            protocol.buffer_updated(chunk_size)
+
+    def analyze():
+        for chunk, is_loud in zip(chunks, loud):
+            if is_loud:
+                spectrum.update(decoder.select(decoder.frames(chunk), MIX)[np.newaxis, :], decoder.scale)
+                fft.calculate_levels_from(spectrum)
+
+    def stats():
+        for matrix in matrices:
+            if matrix is None:
+                visualizer.push_silence()
+            else:
+                visualizer.push_levels(matrix)
+
+    def output():
+        # The recording backend keeps every frame, only the hardware module
+        # itself is measured
+        recording = hardware.get_backend()
+        hardware.set_backend(NullBackend())
+        for row in levels:
+            hardware.set_levels(pins, row)
+        hardware.set_backend(recording)
+
+    return len(chunks), [('ingest', ingest), ('fft', analyze), ('stats', stats), ('output', output)]
+
+
+def measure_stages(audio: bytes, vfilter: Configuration.Filter):
+    count, stages = run_stages(audio, vfilter)
+    results = {}
+    for name, stage in stages:
+        # Warm up, then time and trace separately so tracing doesn't skew the times
+        stage()
+        cpu = time.process_time()
+        stage()
+        cpu = time.process_time() - cpu
+
+        tracemalloc.start()
+        stage()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {'us': cpu / count * 1e6, 'retained': retained, 'peak': peak}
+    return results
+
+
+# --------------------------------------------------------------- #
+# Report
+# --------------------------------------------------------------- #
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) > 0 else float('nan')
+
+
+def benchmark(name: str, args) -> dict:
+    audio = generate(name, args.seconds, args.rate, args.channels, args.format)
+    vfilter = create_filter(args.filter)
+    chunk_duration = protocols.decoder.get_chunk_duration()
+
+    loop = asyncio.get_event_loop()
+    paced = loop.run_until_complete(play(audio, vfilter, chunk_duration))
+    fast = loop.run_until_complete(play(audio, vfilter, 0))
+    stages = measure_stages(audio, vfilter)
+
+    result = {
+        'chunks_per_second': fast['chunks'] / fast['elapsed'],
+        'visualize_p50_us': percentile(paced['durations'], 50) * 1e6,
+        'visualize_p99_us': percentile(paced['durations'], 99) * 1e6,
+        'latency_p50_ms': percentile(paced['latencies'], 50) * 1e3,
+        'latency_p99_ms': percentile(paced['latencies'], 99) * 1e3,
+        'cpu_pct': paced['cpu'] / paced['elapsed'] * 100,
+    }
+    for stage, values in stages.items():
+        result[stage + '_us'] = values['us']
+        result[stage + '_retained_bytes'] = values['retained']
+        result[stage + '_peak_bytes'] = values['peak']
+
+    print('{} ({} Hz, {} channels, {}, {} chunks, {} shown, {} caught up when unpaced)'.format(
+        name, args.rate, args.channels, args.format, paced['chunks'], paced['shown'], fast['chunks'] - len(fast['durations'])))
+    print('  {:>10.0f} chunks/s unpaced   {:5.1f} % CPU paced'.format(result['chunks_per_second'], result['cpu_pct']))
+    print('  visualize()    p50 {:8.1f} us   p99 {:8.1f} us'.format(result['visualize_p50_us'], result['visualize_p99_us']))
+    print('  audio to PWM   p50 {:8.2f} ms   p99 {:8.2f} ms'.format(result['latency_p50_ms'], result['latency_p99_ms']))
+    for stage, values in stages.items():
+        print('  {:<8} {:8.1f} us/chunk   retained {:>6} B   peak {:>7} B'.format(
+            stage, values['us'], values['retained'], values['peak']))
+    return result
+
+
+def best_of(runs):
+    """Returns the best value of each result over several runs, which is
+    the one least disturbed by anything else running on the machine.
+    """
+    best = {}
+    for key in runs[0]:
+        values = [run[key] for run in runs]
+        best[key] = max(values) if key in higher_is_better else min(values)
+    return best
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Prints every result that is worse than its baseline by more than the
+    tolerance and returns whether there were none.
+    """
+    passed = True
+    for name, result in results.items():
+        for key, value in result.items():
+            expected = baseline.get(name, {}).get(key)
+            if expected is None:
+                continue
+            # Also covers baselines of 0, e.g. a stage that allocates nothing
+            if abs(value - expected) <= min_difference[key.split('_')[-1]]:
+                continue
+            if key in higher_is_better:
+                worse = value < expected * (1 - tolerance)
+            else:
+                worse = value > expected * (1 + tolerance)
+            if worse:
+                print('REGRESSION {} {}: {:.2f} (baseline {:.2f})'.format(name, key, value, expected))
+                passed = False
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the visualizer pipeline.')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--rate', type=int, default=44100)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--format', default='S16_LE', choices=sorted(SAMPLE_FORMATS))
+    parser.add_argument('--filter', default='classic')
+    parser.add_argument('--signals', default=','.join(signals))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per signal, the best result of each is kept')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline of this machine')
+    parser.add_argument('--check', action='store_true', help='fail when a result is worse than the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    configure(args.rate, args.channels, args.format)
+    # The FIFO protocol needs uvloop to read pipes into its buffer, as in the server
+    asyncio.set_event_loop(uvloop.new_event_loop())
+    hardware.set_backend(outputs.RecordingBackend(limit=1000))
+    hardware.enable([c.pin for c in config.hardware.channels])
+
+    # Baselines are kept per machine, audio format and build
+    machine = '{} {} Hz {} ch'.format(platform.machine(), args.rate, args.channels)
+    if args.format != 'S16_LE':
+        machine += ' ' + args.format
+    if visualizer_module.__file__.endswith('.py'):
+        machine += ' plain Python'
+    results = {}
+    for name in args.signals.split(','):
+        runs = [benchmark(name, args) for _ in range(args.repeat)]
+        results[name] = best_of(runs)
+
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baselines = json.load(f)
+
+    if args.save:
+        baselines[machine] = results
+        with open(baseline_path, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print('Saved the baseline for ' + machine)
+
+    if args.check:
+        if machine not in baselines:
+            print('FAIL: no baseline for ' + machine + ', run with --save first')
+            sys.exit(1)
+        if not compare(results, baselines[machine], args.tolerance):
+            sys.exit(1)
+        print('No regressions against the baseline for ' + machine)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,11 @@ setup(
     description='Controls RGB LED lights with a RESTful web API.',
     author='M. Barry McAndrews',
     author_email='bmcandrews@pitt.edu',
-    ext_modules=cythonize(['aurora/visualizer/*.pyx', 'aurora/hardware.pyx']),
+    ext_modules=cythonize(['aurora/hardware.py',
+                           'aurora/metrics.py',
+                           'aurora/visualizer/fft.py',
+                           'aurora/visualizer/running_stats.py',
+                           'aurora/visualizer/visualizer.py']),
     requires=install_requires,
     packages=find_packages(),
     data_files=[
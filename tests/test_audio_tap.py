@@ -0,0 +1,107 @@
+import io
+import os
+import time
+import unittest
+
+from aurora import protocols
+from aurora.protocols import AudioFifoProtocol, AudioTap, AudioTapReader, NullSink, chunk_size
+
+
+class RecordingHub(object):
+    """Stands in for the visualizer hub and keeps the chunks it is given."""
+
+    def __init__(self):
+        self.chunks = []
+        self.light_delays = []
+
+    def __len__(self):
+        return 1
+
+    def visualize(self, data):
+        self.chunks.append(bytes(data))
+
+    def catch_up(self, data, count):
+        for i in range(count):
+            self.chunks.append(bytes(data[i * chunk_size:(i + 1) * chunk_size]))
+
+    def set_light_delay(self, chunks):
+        self.light_delays.append(chunks)
+
+
+def make_chunk(i: int) -> bytes:
+    return bytes([i % 256]) * chunk_size
+
+
+class AudioTapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = RecordingHub()
+        AudioFifoProtocol.visualizer_hub = self.hub
+
+    def tearDown(self):
+        AudioFifoProtocol.visualizer_hub = None
+
+    def create_reader(self, tap: AudioTap) -> AudioTapReader:
+        os.set_blocking(tap.notify_reader.fileno(), False)
+        return AudioTapReader(tap)
+
+    def play(self, tap: AudioTap, chunks, latency: float = 0.2):
+        sink = NullSink(latency=latency, realtime=False)
+        protocols.play_stream(io.BytesIO(b''.join(make_chunk(i) for i in chunks)), tap, sink)
+
+    def test_chunks_arrive_in_order(self):
+        # Fewer chunks than backlogChunks, so every one of them is shown
+        tap = AudioTap(slots=8)
+        reader = self.create_reader(tap)
+
+        before = time.monotonic()
+        self.play(tap, range(3))
+        after = time.monotonic()
+        reader.on_ready()
+
+        self.assertEqual(self.hub.chunks, [make_chunk(i) for i in range(3)])
+        for i in range(3):
+            self.assertTrue(before + 0.2 <= tap.timestamps[i] <= after + 0.2)
+        expected_delay = round(0.2 / reader.chunk_duration)
+        self.assertTrue(abs(self.hub.light_delays[-1] - expected_delay) <= 1)
+        self.assertEqual(reader.get_counters(), {'chunks_emitted': 3, 'chunks_dropped': 0, 'overruns': 0})
+
+        # Nothing new, nothing is visualized again
+        reader.on_ready()
+        self.assertEqual(len(self.hub.chunks), 3)
+
+    def test_overrun_skips_to_chunks_that_are_not_overwritten(self):
+        tap = AudioTap(slots=4)
+        reader = self.create_reader(tap)
+
+        self.play(tap, range(10))
+        reader.on_ready()
+
+        # The slot of the oldest chunk is the next one the player writes
+        self.assertEqual(self.hub.chunks, [make_chunk(i) for i in range(7, 10)])
+        self.assertEqual(reader.get_counters(), {'chunks_emitted': 3, 'chunks_dropped': 7, 'overruns': 1})
+
+        self.play(tap, range(10, 12))
+        reader.on_ready()
+        self.assertEqual(self.hub.chunks[3:], [make_chunk(10), make_chunk(11)])
+        self.assertEqual(reader.get_counters(), {'chunks_emitted': 5, 'chunks_dropped': 7, 'overruns': 1})
+
+    def test_cursor_wraps_around(self):
+        tap = AudioTap(slots=4)
+        tap.cursor.value = protocols.CURSOR_MASK - 1
+        reader = self.create_reader(tap)
+
+        self.play(tap, range(3))
+        reader.on_ready()
+
+        self.assertEqual(tap.cursor.value, 1)
+        self.assertEqual(self.hub.chunks, [make_chunk(i) for i in range(3)])
+        self.assertEqual(reader.get_counters(), {'chunks_emitted': 3, 'chunks_dropped': 0, 'overruns': 0})
+
+    def test_slots_must_be_a_power_of_two(self):
+        with self.assertRaises(ValueError):
+            AudioTap(slots=6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import asyncio
+import multiprocessing
+import socket
+import time
+import unittest
+
+# Every node runs in a process of its own, with its own configuration and
+# hardware module. They talk over multicast on the loopback interface.
+GROUP = '239.255.77.77'
+DELAY = 0.2
+
+LEADER_CHANNELS = [
+    {'pin': 2, 'label': 'red', 'device': 'Ceiling'},
+    {'pin': 3, 'label': 'green', 'device': 'Ceiling'},
+    {'pin': 0, 'label': 'blue', 'device': 'Ceiling'},
+    {'pin': 22, 'label': 'red', 'device': 'Backlight'},
+]
+LEADER_PINS = [c['pin'] for c in LEADER_CHANNELS]
+
+# The same channels on other pins, and a room with only some of the
+# leader's channels and one it doesn't have
+CEILING_ROOM = [
+    {'pin': 5, 'label': 'red', 'device': 'Ceiling'},
+    {'pin': 6, 'label': 'green', 'device': 'Ceiling'},
+    {'pin': 7, 'label': 'blue', 'device': 'Ceiling'},
+]
+MIXED_ROOM = [
+    {'pin': 1, 'label': 'red', 'device': 'Backlight'},
+    {'pin': 2, 'label': 'red', 'device': 'Ceiling'},
+    {'pin': 3, 'label': 'white', 'device': 'Lamp'},
+]
+
+
+def configure(port: int, channels):
+    from aurora.configuration import Channel, get_config
+    config = get_config()
+    config.hardware.output = 'recording'
+    config.hardware.channels = [Channel(dict(c)) for c in channels]
+    config.hardware.corrections = []
+    config.hardware.dithering = False
+    config.cluster.group = GROUP
+    config.cluster.port = port
+    config.cluster.interface = '127.0.0.1'
+    config.cluster.buffer_delay = DELAY
+    return config
+
+
+def run_leader(port: int, frames, results):
+    configure(port, LEADER_CHANNELS).cluster.role = 'leader'
+    from aurora import cluster, hardware, outputs
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    cluster.start(loop)
+    backend = hardware.get_backend()
+    loop.create_task(outputs.keep_alive(backend))
+    hardware.enable(LEADER_PINS)
+
+    async def play():
+        # The map is sent with the first refresh
+        await asyncio.sleep(cluster.keepalive_interval)
+        set_at = []
+        for levels in frames:
+            set_at.append(time.monotonic())
+            hardware.set_levels(LEADER_PINS, levels)
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(DELAY + 0.2)
+        return set_at
+
+    set_at = loop.run_until_complete(play())
+    results.put(('leader', set_at, list(backend.inner.frames)))
+
+
+def run_follower(port: int, channels, duration: float, ready, results):
+    configure(port, channels).cluster.role = 'follower'
+    from aurora import cluster, hardware
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    cluster.start(loop)
+    loop.run_until_complete(asyncio.sleep(0.1))
+    ready.set()
+    loop.run_until_complete(asyncio.sleep(duration))
+    backend = hardware.get_backend()
+    results.put((channels[0]['pin'], dict(backend.levels), list(backend.frames), cluster.follower.get_counters()))
+
+
+def run_faulty_leader(port: int, results):
+    """Sends a bad map and then frames that are lost, reordered and late,
+    as a leader on a poor network would be seen.
+    """
+    config = configure(port, LEADER_CHANNELS)
+    import json
+    import numpy as np
+    from aurora import cluster
+
+    sock = cluster.open_socket(config.cluster, receive=False)
+    payload = json.dumps([[c['device'], c['label']] for c in LEADER_CHANNELS]).encode()
+
+    def send(kind: int, sequence: int, sent_at: float, body: bytes, map_id: int = 1):
+        sock.sendto(cluster.header.pack(cluster.MAGIC, kind, 7, map_id, sequence, sent_at) + body,
+                    (GROUP, port))
+
+    def frame(level: int) -> bytes:
+        return np.rint(np.full(len(LEADER_CHANNELS), level * cluster.frame_scale)).astype(cluster.frame_type).tobytes()
+
+    send(cluster.KIND_MAP, 0, time.monotonic(), b'{not json', map_id=2)
+    send(cluster.KIND_MAP, 0, time.monotonic(), payload)
+    time.sleep(0.05)
+    send(cluster.KIND_FRAME, 1, time.monotonic(), frame(10))
+    time.sleep(0.05)
+    send(cluster.KIND_FRAME, 2, time.monotonic(), frame(20))
+    time.sleep(0.05)
+    # Frame 3 is lost and frame 4 arrives after frame 5
+    now = time.monotonic()
+    send(cluster.KIND_FRAME, 5, now, frame(50))
+    send(cluster.KIND_FRAME, 4, now - 0.02, frame(40))
+    time.sleep(DELAY + 0.1)
+    # Frame 2 again, long after it was shown
+    send(cluster.KIND_FRAME, 2, now - 0.1, frame(20))
+    results.put(('leader',))
+
+
+def free_port() -> int:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        # Spawned, so that every node imports its own configuration
+        self.context = multiprocessing.get_context('spawn')
+        self.port = free_port()
+        self.results = self.context.Queue()
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+
+    def start(self, target, *args):
+        process = self.context.Process(target=target, args=(self.port,) + args + (self.results,),
+                                       daemon=True)
+        process.start()
+        self.processes.append(process)
+
+    def collect(self, count: int):
+        return [self.results.get(timeout=30) for _ in range(count)]
+
+    def test_followers_show_the_leader_frames_at_the_same_moment(self):
+        # Ceiling red changes in every frame, so every room records each one
+        frames = [[10, 20, 30, 40], [50, 20, 30, 40], [60, 70, 80, 90]]
+        ready = [self.context.Event(), self.context.Event()]
+        self.start(run_follower, CEILING_ROOM, 4.0, ready[0])
+        self.start(run_follower, MIXED_ROOM, 4.0, ready[1])
+        for event in ready:
+            self.assertTrue(event.wait(30))
+        self.start(run_leader, frames)
+
+        results = self.collect(3)
+        _, set_at, leader_frames = [r for r in results if r[0] == 'leader'][0]
+        rooms = {r[0]: r[1:] for r in results if r[0] != 'leader'}
+
+        levels, ceiling_frames, counters = rooms[CEILING_ROOM[0]['pin']]
+        self.assertEqual(levels, {5: 60, 6: 70, 7: 80})
+        self.assertEqual(counters['frames_lost'], 0)
+        self.assertEqual(counters['invalid_datagrams'], 0)
+
+        # Lamp white is not one of the leader's channels and is left alone
+        levels, mixed_frames, _ = rooms[MIXED_ROOM[0]['pin']]
+        self.assertEqual(levels, {1: 90, 2: 60})
+
+        # Until the first frame the leader repeats the levels of its enabled
+        # pins, which the followers show as well
+        self.assertEqual(len(leader_frames), len(frames))
+        self.assertEqual(ceiling_frames[0][2], (0, 0, 0))
+        self.assertEqual(mixed_frames[0][2], (0, 0))
+        ceiling_frames = ceiling_frames[1:]
+        mixed_frames = mixed_frames[1:]
+        self.assertEqual(len(ceiling_frames), len(frames))
+        self.assertEqual(len(mixed_frames), len(frames))
+        for i in range(len(frames)):
+            shown_at = leader_frames[i][0]
+            # The leader holds its own lights back as long as the followers
+            self.assertGreaterEqual(shown_at - set_at[i], DELAY - 0.01)
+            self.assertLess(abs(ceiling_frames[i][0] - shown_at), 0.03)
+            self.assertLess(abs(mixed_frames[i][0] - shown_at), 0.03)
+
+    def test_lost_reordered_and_late_frames(self):
+        ready = self.context.Event()
+        self.start(run_follower, CEILING_ROOM, 3.0, ready)
+        self.assertTrue(ready.wait(30))
+        self.start(run_faulty_leader)
+
+        results = self.collect(2)
+        levels, frames, counters = [r for r in results if r[0] != 'leader'][0][1:]
+
+        # The levels of the last frame are held once the leader goes quiet
+        self.assertEqual(levels, {5: 50, 6: 50, 7: 50})
+        self.assertEqual([f[2] for f in frames], [(10,) * 3, (20,) * 3, (40,) * 3, (50,) * 3])
+        self.assertEqual(counters['invalid_datagrams'], 1)
+        self.assertEqual(counters['frames_received'], 5)
+        self.assertEqual(counters['frames_shown'], 4)
+        self.assertEqual(counters['frames_lost'], 1)
+        self.assertEqual(counters['frames_late'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import asyncio
+import time
+import unittest
+
+from aurora.configuration import get_config
+
+# The hardware module creates its backend when it is imported
+get_config().hardware.output = 'recording'
+
+from aurora import lights
+from aurora.displayables import Levels
+from aurora.preset import Preset
+
+CEILING = {'red': 10, 'green': 20, 'blue': 30}
+
+
+class RetargetDeviceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = get_config()
+        self.enable_transitions = self.config.core.enable_transitions
+        self.config.core.enable_transitions = False
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(lights.clear_presets())
+        lights.compositor.tick(time.monotonic())
+        self.loop.close()
+        self.config.core.enable_transitions = self.enable_transitions
+
+    def put(self, name: str, channels) -> Preset:
+        preset = Preset(name, channels, {'type': 'levels', 'levels': dict(CEILING)}, Levels(dict(CEILING)))
+        self.loop.run_until_complete(lights.put_presets([preset]))
+        lights.compositor.tick(time.monotonic())
+        return preset
+
+    def test_partial_patch_in_place(self):
+        preset = self.put('Ceiling', lights.device_channels['Ceiling'])
+
+        retargeted = self.loop.run_until_complete(lights.retarget_device('Ceiling', {'red': 80}))
+
+        self.assertEqual(retargeted, [preset])
+        self.assertEqual(preset.levels, {'red': 80, 'green': 20, 'blue': 30})
+
+    def test_partial_patch_of_a_preset_spanning_devices(self):
+        # Can't be retargeted in place, it would change the other device too
+        self.put('Both', lights.device_channels['Ceiling'] + lights.device_channels['Backlight'])
+
+        retargeted = self.loop.run_until_complete(lights.retarget_device('Ceiling', {'red': 80}))
+
+        self.assertEqual(len(retargeted), 1)
+        self.assertEqual(retargeted[0].payload['levels'], {'red': 80, 'green': 20, 'blue': 30})
+        lights.compositor.tick(time.monotonic())
+        self.assertEqual(lights.compositor.get_levels(lights.device_channels['Ceiling']),
+                         {'red': 80, 'green': 20, 'blue': 30})
+        # The rest of the old preset is blanked
+        self.assertEqual(lights.compositor.get_levels(lights.device_channels['Backlight']),
+                         {'red': 0, 'green': 0, 'blue': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
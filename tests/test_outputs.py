@@ -0,0 +1,158 @@
+import socket
+import struct
+import unittest
+
+from aurora.outputs import ArtNetBackend, NetworkBackend, OutputBackend, SacnBackend
+
+
+class NetworkBackendTest(unittest.TestCase):
+    """Sends frames to a UDP socket on the loopback interface and checks
+    the bytes that arrive.
+    """
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(1.0)
+        self.port = self.receiver.getsockname()[1]
+
+    def tearDown(self):
+        self.receiver.close()
+
+    def receive(self) -> bytes:
+        return self.receiver.recv(2048)
+
+    def assertNothingReceived(self):
+        self.receiver.settimeout(0.05)
+        with self.assertRaises(socket.timeout):
+            self.receive()
+        self.receiver.settimeout(1.0)
+
+    def test_sacn_packet(self):
+        backend = SacnBackend('127.0.0.1', self.port, 1)
+        backend.enable([0, 1, 2])
+        backend.write(0, 255)
+        backend.write(2, 17)
+        backend.flush()
+
+        packet = self.receive()
+        self.assertEqual(len(packet), 126 + 3)
+        # Root layer
+        self.assertEqual(packet[0:16], b'\x00\x10\x00\x00ASC-E1.17\x00\x00\x00')
+        self.assertEqual(struct.unpack_from('!HI', packet, 16), (0x7000 | (len(packet) - 16), 0x00000004))
+        self.assertEqual(packet[22:38], backend.cid)
+        # Framing layer
+        self.assertEqual(struct.unpack_from('!HI', packet, 38), (0x7000 | (len(packet) - 38), 0x00000002))
+        self.assertEqual(packet[44:108].rstrip(b'\x00'), backend.source_name)
+        self.assertEqual(packet[108], 100)
+        self.assertEqual(packet[111], 1)
+        self.assertEqual(struct.unpack_from('!H', packet, 113)[0], 1)
+        # DMP layer
+        self.assertEqual(struct.unpack_from('!HBBHHHB', packet, 115),
+                         (0x7000 | (len(packet) - 115), 0x02, 0xa1, 0x0000, 0x0001, 4, 0x00))
+        self.assertEqual(packet[126:], bytes([255, 0, 17]))
+
+        # Only frames that changed are sent, each with the next sequence number
+        backend.flush()
+        self.assertNothingReceived()
+        backend.write(1, 128)
+        backend.flush()
+        packet = self.receive()
+        self.assertEqual(packet[111], 2)
+        self.assertEqual(packet[126:], bytes([255, 128, 17]))
+
+        backend.refresh_interval = 0
+        backend.refresh()
+        self.assertEqual(self.receive()[111], 3)
+
+    def test_sacn_universes(self):
+        backend = SacnBackend('127.0.0.1', self.port, 1)
+        backend.write(512 + 4, 9)
+        backend.flush()
+
+        packet = self.receive()
+        self.assertEqual(len(packet), 126 + 512)
+        self.assertEqual(struct.unpack_from('!H', packet, 113)[0], 2)
+        self.assertEqual(packet[126 + 4], 9)
+
+    def test_sequence_continues_when_a_universe_grows(self):
+        backend = SacnBackend('127.0.0.1', self.port, 1)
+        backend.enable([0])
+        backend.write(0, 1)
+        backend.flush()
+        self.assertEqual(self.receive()[111], 1)
+
+        # Pin 9 was not enabled, the universe grows to all 512 slots
+        backend.write(9, 2)
+        backend.flush()
+        packet = self.receive()
+        self.assertEqual(len(packet), 126 + 512)
+        self.assertEqual(packet[111], 2)
+        self.assertEqual(packet[126], 1)
+        self.assertEqual(packet[126 + 9], 2)
+
+    def test_sequence_wraps_from_255_to_1(self):
+        backend = SacnBackend('127.0.0.1', self.port, 1)
+        backend.enable([0])
+        for i in range(256):
+            backend.write(0, i % 2)
+            backend.flush()
+            self.assertEqual(self.receive()[111], i % 255 + 1)
+
+    def test_artnet_packet(self):
+        backend = ArtNetBackend('127.0.0.1', self.port, 0)
+        backend.enable([0, 1, 2])
+        backend.write(0, 255)
+        backend.write(2, 17)
+        backend.flush()
+
+        packet = self.receive()
+        # The data length is padded to an even number of slots
+        self.assertEqual(len(packet), 18 + 4)
+        self.assertEqual(packet[0:8], b'Art-Net\x00')
+        self.assertEqual(struct.unpack_from('<H', packet, 8)[0], 0x5000)
+        self.assertEqual(struct.unpack_from('!H', packet, 10)[0], 14)
+        self.assertEqual(packet[12], 1)
+        self.assertEqual(packet[14], 0)
+        self.assertEqual(packet[15], 0)
+        self.assertEqual(struct.unpack_from('!H', packet, 16)[0], 4)
+        self.assertEqual(packet[18:], bytes([255, 0, 17, 0]))
+
+        backend.write(1, 128)
+        backend.flush()
+        packet = self.receive()
+        self.assertEqual(packet[12], 2)
+        self.assertEqual(packet[18:], bytes([255, 128, 17, 0]))
+
+    def test_artnet_port_address(self):
+        # Universe 0x123 is Net 0x01 and SubUni 0x23
+        backend = ArtNetBackend('127.0.0.1', self.port, 0x122)
+        backend.write(512 + 1, 200)
+        backend.flush()
+
+        packet = self.receive()
+        self.assertEqual(packet[14], 0x23)
+        self.assertEqual(packet[15], 0x01)
+        self.assertEqual(struct.unpack_from('!H', packet, 16)[0], 512)
+        self.assertEqual(packet[18 + 1], 200)
+
+
+class IncompleteBackendTest(unittest.TestCase):
+
+    def test_backends_must_implement_write(self):
+        class NoWrite(OutputBackend):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoWrite()
+
+    def test_network_backends_must_build_packets(self):
+        class NoPacket(NetworkBackend):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoPacket('127.0.0.1', 0, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()